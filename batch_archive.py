@@ -0,0 +1,26 @@
+"""Stream generated instruction workbooks into a zip archive.
+
+Each workbook is added to the archive as soon as it is produced and dropped
+right after, so memory holds a single workbook at a time however large the
+batch: ``write_zip`` streams to a file on disk, which the download then
+reads back only when it is requested.
+"""
+import zipfile
+
+# xlsx files are zip archives already, deflating them again saves next to nothing
+COMPRESSION = zipfile.ZIP_STORED
+
+
+def write_zip(files, target, compression=COMPRESSION):
+    """Write ``(file_name, content)`` pairs into a zip at ``target`` as they arrive.
+
+    ``target`` is a path or a binary file object; returns the number of
+    files written.
+    """
+    count = 0
+    with zipfile.ZipFile(target, 'w', compression) as archive:
+        for file_name, content in files:
+            archive.writestr(file_name, content)
+            count += 1
+    return count
+
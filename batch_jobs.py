@@ -0,0 +1,205 @@
+"""Run batch generations in the background, outside any Streamlit script run.
+
+A ``JobQueue`` owns a small pool of threads that each drive one batch at a
+time, the batch itself spread over worker processes by
+``ParallelGenerator``. Jobs are identified by an ID, report how many parts
+are done, can be cancelled between parts and keep their result file on disk
+until discarded or expired. A long batch therefore survives reruns of the
+page, and a busy server runs at most ``max_jobs`` batches at once while the
+others wait their turn.
+"""
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from batch_archive import write_zip
+from ooxml_writer import get_compiled_sheet
+from parallel_generation import ParallelGenerator
+
+logger = logging.getLogger(__name__)
+
+# Job states
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+FINISHED_STATES = (DONE, FAILED, CANCELLED)
+
+# Result of a job: a zip of one workbook per part, or one workbook with a sheet per part
+OUTPUTS = ('zip', 'workbook')
+
+# Batches generated at the same time; further jobs wait in the queue
+DEFAULT_MAX_JOBS = 2
+# Seconds a finished job and its result file are kept
+DEFAULT_RESULT_TTL = 3600
+
+
+class JobCancelled(Exception):
+    """Raised inside a job's thread once the job is cancelled"""
+
+
+class BatchJob:
+    """State of one background batch, updated by its thread and read by the page"""
+
+    def __init__(self, job_id, total, output):
+        # total is None for a stream of records of unknown length
+        self.id = job_id
+        self.total = total
+        self.output = output
+        self.completed = 0
+        self.state = QUEUED
+        self.error = None
+        self.result_path = None
+        self.created = time.time()
+        self.finished = None
+        self._cancel = threading.Event()
+
+    @property
+    def progress(self):
+        """Fraction of the parts done, None while the total is unknown"""
+        if self.total is None:
+            return None
+        return self.completed / self.total if self.total else 1.0
+
+    @property
+    def active(self):
+        return self.state not in FINISHED_STATES
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def cancel(self):
+        """Ask the job to stop before its next part"""
+        self._cancel.set()
+
+    def track(self, items):
+        """Count the parts consumed from ``items``, stopping when the job is cancelled"""
+        try:
+            for item in items:
+                if self.cancelled:
+                    raise JobCancelled
+                yield item
+                self.completed += 1
+        finally:
+            # Closing the part generator lets it cancel the work still queued
+            close = getattr(items, 'close', None)
+            if close is not None:
+                close()
+
+
+class JobQueue:
+    """Background batch jobs shared by every session of the server"""
+
+    def __init__(self, manager, max_jobs=DEFAULT_MAX_JOBS, result_ttl=DEFAULT_RESULT_TTL, result_dir=None):
+        self.manager = manager
+        self.result_ttl = result_ttl
+        self.result_dir = result_dir or tempfile.mkdtemp(prefix='packaging_jobs_')
+        self._executor = ThreadPoolExecutor(max_workers=max_jobs, thread_name_prefix='batch-job')
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, records, procedure_type=None, images_data=None, row_images=None, output='zip',
+               writer='openpyxl', workers=1):
+        """Queue the instructions of ``records`` and return the job's ID.
+
+        ``records`` may be a lazy stream such as ``iter_records_from_excel``;
+        it is consumed by the job's thread as the parts are generated.
+        """
+        if output not in OUTPUTS:
+            raise ValueError(f"Unknown output {output!r}, expected one of {OUTPUTS}")
+        self.purge()
+        job = BatchJob(uuid.uuid4().hex, len(records) if hasattr(records, '__len__') else None, output)
+        with self._lock:
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job, records, procedure_type, images_data, row_images, writer, workers)
+        return job.id
+
+    def get(self, job_id):
+        """The job with this ID, None once it was discarded or expired"""
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        if job is not None:
+            job.cancel()
+
+    def discard(self, job_id):
+        """Cancel a job if it still runs and forget it along with its result"""
+        with self._lock:
+            job = self._jobs.pop(job_id, None)
+        if job is not None:
+            job.cancel()
+            self._remove_result(job)
+
+    def purge(self):
+        """Forget the jobs that finished more than ``result_ttl`` seconds ago"""
+        deadline = time.time() - self.result_ttl
+        with self._lock:
+            expired = [job for job in self._jobs.values() if job.finished is not None and job.finished < deadline]
+            for job in expired:
+                del self._jobs[job.id]
+        for job in expired:
+            self._remove_result(job)
+
+    def shutdown(self):
+        """Cancel every job, wait for their threads and delete the results"""
+        with self._lock:
+            jobs = list(self._jobs.values())
+            self._jobs.clear()
+        for job in jobs:
+            job.cancel()
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        shutil.rmtree(self.result_dir, ignore_errors=True)
+
+    def _remove_result(self, job):
+        if job.result_path and os.path.exists(job.result_path):
+            os.remove(job.result_path)
+
+    def _run(self, job, records, procedure_type, images_data, row_images, writer, workers):
+        path = os.path.join(self.result_dir, f"{job.id}.{'xlsx' if job.output == 'workbook' else 'zip'}")
+        state = FAILED
+        try:
+            if job.cancelled:
+                raise JobCancelled
+            job.state = RUNNING
+            if job.output == 'workbook':
+                manager = self.manager
+                batch = manager.iter_batch_form_data(records, procedure_type)
+                sheets = (
+                    (manager.batch_sheet_title(form_data, index), form_data,
+                     manager.images_for_record(form_data, images_data, row_images))
+                    for index, form_data in job.track(enumerate(batch, 1))
+                )
+                with open(path, 'wb') as handle:
+                    get_compiled_sheet(manager).render_workbook(sheets, handle)
+            else:
+                generator = ParallelGenerator(max_workers=workers, ordered=False, writer=writer)
+                parts = job.track(generator.generate(records, procedure_type, images_data, row_images))
+                write_zip(((file_name, content) for _, file_name, content in parts), path)
+        except JobCancelled:
+            state = CANCELLED
+        except Exception as e:
+            logger.exception("Batch job %s failed", job.id)
+            job.error = str(e)
+            state = FAILED
+        else:
+            job.result_path = path
+            job.total = job.completed
+            state = DONE
+        finally:
+            if state != DONE and os.path.exists(path):
+                os.remove(path)
+            # Discarded while running: nobody will ask for the result any more
+            if self.get(job.id) is None:
+                self._remove_result(job)
+            # Published last, the page only sees a finished job once its files are settled
+            job.finished = time.time()
+            job.state = state
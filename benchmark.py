@@ -0,0 +1,223 @@
+"""Reproducible benchmarks of the instruction pipeline on synthetic workbooks.
+
+Generates master sheets of a given size (rows, column-alias variety, number
+and size of embedded images), times each pipeline stage on them and writes
+the results as JSON so that runs can be compared:
+
+    python benchmark.py --rows 10 100 1000 --images 4 --output bench.json
+    python benchmark.py --rows 10 100 1000 --compare bench.json
+"""
+import argparse
+import io
+import json
+import platform
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timezone
+
+import openpyxl
+import pandas as pd
+import PIL
+from openpyxl.drawing.image import Image
+from PIL import Image as PILImage
+
+import image_pipeline
+from template_manager import ExactPackagingTemplateManager, TEMPLATE_VERSION
+
+# Image header columns, in the order the synthetic sheets place them
+IMAGE_HEADERS = ['Current Packaging', 'Primary Packaging', 'Secondary Packaging', 'Label']
+
+OPERATIONS = (
+    'extract_data_from_excel',
+    'extract_images_from_excel',
+    'create_exact_template_excel',
+    'populate_template_with_data',
+    'wb.save',
+)
+
+
+def _field_aliases(manager):
+    """Header spellings accepted for every field, canonical spelling first"""
+    aliases = {}
+    for alias, field in manager.field_mapping.items():
+        aliases.setdefault(field, []).append(alias)
+    return aliases
+
+
+def synthetic_workbook(rows, alias_variety=1, images=4, image_size=(400, 300), seed=0):
+    """Build a master parts sheet as xlsx bytes.
+
+    ``alias_variety`` is how many header spellings per field are drawn from
+    ``field_mapping`` (1 keeps the canonical one); ``images`` pictures of
+    ``image_size`` pixels are anchored below the image category headers,
+    one row per part until they run out.
+    """
+    rng = random.Random(seed)
+    manager = ExactPackagingTemplateManager()
+    headers = []
+    for field, aliases in _field_aliases(manager).items():
+        if field.startswith('Procedure Step'):
+            continue
+        alias = rng.choice(aliases[:max(1, alias_variety)])
+        headers.append((field, alias.title() if rng.random() < 0.5 else alias.upper()))
+
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.append([alias for _, alias in headers] + IMAGE_HEADERS)
+    for row in range(rows):
+        values = []
+        for field, _ in headers:
+            if any(word in field for word in (' L', ' W', ' H', 'Qty', 'Weight', 'Layer', 'Level')):
+                values.append(rng.randint(1, 1200))
+            else:
+                values.append(f"{field} {row + 1}")
+        ws.append(values)
+
+    first_image_col = len(headers) + 1
+    for index in range(images):
+        color = tuple(rng.randrange(256) for _ in range(3))
+        picture = PILImage.new('RGB', image_size, color)
+        # A little noise keeps the PNG from compressing to nothing
+        for _ in range(200):
+            picture.putpixel((rng.randrange(image_size[0]), rng.randrange(image_size[1])), (0, 0, 0))
+        buffer = io.BytesIO()
+        picture.save(buffer, format='PNG')
+        buffer.seek(0)
+        column = openpyxl.utils.get_column_letter(first_image_col + index % len(IMAGE_HEADERS))
+        ws.add_image(Image(buffer), f"{column}{2 + index // len(IMAGE_HEADERS)}")
+
+    output = io.BytesIO()
+    wb.save(output)
+    return output.getvalue()
+
+
+def _time(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        # Preparing the inputs decodes and encodes their pictures; every run
+        # starts from empty picture caches, as the first upload of a sheet does
+        image_pipeline.clear_caches()
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def benchmark_scale(manager, rows, alias_variety, images, image_size, repeat):
+    """Time every pipeline operation on one synthetic workbook"""
+    content = synthetic_workbook(rows, alias_variety, images, image_size)
+    upload = io.BytesIO(content)
+
+    def extract_data():
+        upload.seek(0)
+        return manager.extract_data_from_excel(upload)
+
+    def extract_images():
+        upload.seek(0)
+        return manager.extract_images_from_excel(upload)
+
+    extracted_data = extract_data()
+    images_data = extract_images()
+    form_data = manager.build_form_data(extracted_data, 'BOX IN BOX')
+    # Workbooks are prepared up front so each operation is timed on its own;
+    # openpyxl closes embedded image streams on save, so each is saved once
+    blanks = [manager.get_template_workbook() for _ in range(repeat)]
+    populated = [
+        manager.populate_template_with_data(manager.get_template_workbook(), form_data, None, images_data)
+        for _ in range(repeat)
+    ]
+
+    operations = {
+        'extract_data_from_excel': extract_data,
+        'extract_images_from_excel': extract_images,
+        'create_exact_template_excel': manager.create_exact_template_excel,
+        'populate_template_with_data': lambda: manager.populate_template_with_data(
+            blanks.pop(), form_data, None, images_data),
+        'wb.save': lambda: populated.pop().save(io.BytesIO()),
+    }
+    results = []
+    for operation in OPERATIONS:
+        timings = _time(operations[operation], repeat)
+        results.append({
+            'operation': operation,
+            'rows': rows,
+            'alias_variety': alias_variety,
+            'images': images,
+            'image_size': list(image_size),
+            'input_bytes': len(content),
+            'repeat': repeat,
+            'min_seconds': min(timings),
+            'median_seconds': statistics.median(timings),
+        })
+    return results
+
+
+def run_benchmarks(rows_list, alias_variety=1, images=4, image_size=(400, 300), repeat=3):
+    """Run every scale and return a JSON-serializable report"""
+    manager = ExactPackagingTemplateManager()
+    results = []
+    for rows in rows_list:
+        results.extend(benchmark_scale(manager, rows, alias_variety, images, image_size, repeat))
+    return {
+        'created': datetime.now(tz=timezone.utc).isoformat(timespec='seconds'),
+        'template_version': TEMPLATE_VERSION,
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'pandas': pd.__version__,
+            'openpyxl': openpyxl.__version__,
+            'pillow': PIL.__version__,
+        },
+        'results': results,
+    }
+
+
+def compare_reports(baseline, current):
+    """Lines comparing the median time of every operation and scale of two reports"""
+    def key(result):
+        return (result['operation'], result['rows'], result['alias_variety'],
+                result['images'], tuple(result['image_size']))
+
+    previous = {key(result): result for result in baseline['results']}
+    lines = []
+    for result in current['results']:
+        before = previous.get(key(result))
+        if before is None:
+            continue
+        ratio = result['median_seconds'] / before['median_seconds'] if before['median_seconds'] else float('inf')
+        lines.append(f"{result['operation']:<30} rows={result['rows']:<7} "
+                     f"{before['median_seconds'] * 1000:10.1f} ms -> {result['median_seconds'] * 1000:10.1f} ms "
+                     f"({ratio:.2f}x)")
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, nargs='+', default=[10, 100, 1000], help="Part rows per synthetic sheet")
+    parser.add_argument('--alias-variety', type=int, default=1, help="Header spellings drawn per field")
+    parser.add_argument('--images', type=int, default=4, help="Embedded images per sheet")
+    parser.add_argument('--image-size', type=int, nargs=2, default=[400, 300], metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--repeat', type=int, default=3, help="Timed runs per operation")
+    parser.add_argument('--output', help="Write the JSON report to this file instead of stdout")
+    parser.add_argument('--compare', help="Previous JSON report to compare against")
+    args = parser.parse_args(argv)
+
+    report = run_benchmarks(args.rows, args.alias_variety, args.images, tuple(args.image_size), args.repeat)
+    if args.output:
+        with open(args.output, 'w') as handle:
+            json.dump(report, handle, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+    if args.compare:
+        with open(args.compare) as handle:
+            baseline = json.load(handle)
+        for line in compare_reports(baseline, report):
+            print(line, file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
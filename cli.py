@@ -0,0 +1,179 @@
+"""Generate packaging instructions from the command line, without Streamlit.
+
+Every input master sheet, or every master sheet of an input directory, gets
+one instruction workbook per part row, written to a folder (or, with
+``--zip``, a zip archive) named after it below the output directory:
+
+    python cli.py masters/ --packaging-type "BOX IN BOX" --workers 4 --output-dir out/
+
+With ``--stream`` the part rows are read from the sheet as they are
+generated instead of all at once, which keeps very large masters within a
+bounded amount of memory.
+
+``--check`` only checks the part data of each input (numbers and units,
+nesting dimensions, pack weights, the fields the procedure needs) and logs
+every problem found, without generating anything.
+
+The exit status is 1 when any input could not be read, had no part rows or,
+with ``--check``, had problems, so that a scheduled run notices the failure.
+"""
+import argparse
+import io
+import logging
+import os
+import sys
+from contextlib import nullcontext
+from itertools import chain
+from pathlib import Path
+
+from batch_archive import write_zip
+from instrumentation import timed_run
+from ooxml_writer import get_compiled_sheet
+from parallel_generation import ParallelGenerator, WRITERS
+from template_manager import ExactPackagingTemplateManager
+
+logger = logging.getLogger(__name__)
+
+# Master sheets picked up from input directories, as accepted by the app
+INPUT_SUFFIXES = ('.xlsx', '.xls')
+
+
+def find_inputs(paths):
+    """Master sheets named by ``paths``, directories expanded to the sheets they hold"""
+    for path in map(Path, paths):
+        if path.is_dir():
+            yield from sorted(
+                child for child in path.iterdir()
+                # Skip the lock files Excel leaves next to open workbooks
+                if child.suffix.lower() in INPUT_SUFFIXES and not child.name.startswith('~$')
+            )
+        else:
+            yield path
+
+
+def generate_for_input(manager, path, output_dir, procedure_type=None, workers=1, writer='openpyxl',
+                       single_workbook=False, archive=False, stream=False):
+    """Write the instructions of every part of one master sheet and return how many"""
+    upload = io.BytesIO(path.read_bytes())
+    if stream:
+        records = manager.iter_records_from_excel(upload)
+        first = next(records, None)
+        if first is None:
+            return 0
+        records = chain([first], records)
+    else:
+        records = manager.extract_records_from_excel(upload)
+        if not records:
+            return 0
+    images_data, row_images = manager.extract_sheet_images_from_excel(upload)
+
+    if single_workbook:
+        output_dir.mkdir(parents=True, exist_ok=True)
+        batch = manager.iter_batch_form_data(records, procedure_type)
+        count = 0
+
+        def sheets():
+            nonlocal count
+            for count, form_data in enumerate(batch, 1):
+                yield (manager.batch_sheet_title(form_data, count), form_data,
+                       manager.images_for_record(form_data, images_data, row_images))
+
+        with open(output_dir / f"{path.stem}_instructions.xlsx", 'wb') as handle:
+            get_compiled_sheet(manager).render_workbook(sheets(), handle)
+        return count
+
+    generator = ParallelGenerator(max_workers=workers, ordered=False, writer=writer)
+    files = (
+        (file_name, content)
+        for _, file_name, content in generator.generate(records, procedure_type, images_data, row_images)
+    )
+    if archive:
+        output_dir.mkdir(parents=True, exist_ok=True)
+        return write_zip(files, output_dir / f"{path.stem}.zip")
+
+    target_dir = output_dir / path.stem
+    target_dir.mkdir(parents=True, exist_ok=True)
+    count = 0
+    for file_name, content in files:
+        (target_dir / file_name).write_bytes(content)
+        count += 1
+    return count
+
+
+def check_input(manager, path, procedure_type=None, stream=False):
+    """Log the problems found in the part rows of one master sheet and return how many"""
+    upload = io.BytesIO(path.read_bytes())
+    if stream:
+        count = 0
+
+        def records():
+            nonlocal count
+            for count, record in enumerate(manager.iter_records_from_excel(upload), 1):
+                yield record
+
+        issues = manager.validate_record_stream(records(), procedure_type)
+    else:
+        parts = manager.extract_records_from_excel(upload)
+        count = len(parts)
+        issues = manager.validate_records(parts, procedure_type).issues if parts else None
+    if not count:
+        logger.error("%s: no part rows found", path)
+        return 1
+    for row, part_no, field, problem in issues.itertuples(index=False, name=None):
+        logger.warning("%s row %s (%s): %s %s", path, row, part_no, field, problem)
+    logger.info("%s: %d parts checked, %d problems", path, count, len(issues))
+    return len(issues)
+
+
+def main(argv=None):
+    manager = ExactPackagingTemplateManager()
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('inputs', nargs='+', help="Master parts sheets, or directories of them")
+    parser.add_argument('-o', '--output-dir', type=Path, help="Directory the instructions are written to")
+    parser.add_argument('-t', '--packaging-type', choices=list(manager.packaging_procedures),
+                        help="Packaging procedure whose steps fill the instructions")
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count() or 1, help="Worker processes")
+    parser.add_argument('--writer', choices=WRITERS, default=WRITERS[0], help="Workbook writer backend")
+    parser.add_argument('--single-workbook', action='store_true',
+                        help="Write one workbook per input with a sheet per part instead of a file per part")
+    parser.add_argument('--zip', action='store_true', help="Write the files of each input into one zip archive")
+    parser.add_argument('--stream', action='store_true',
+                        help="Read the part rows while generating or checking instead of loading the whole sheet first")
+    parser.add_argument('--check', action='store_true',
+                        help="Only check the part data of each input and report the problems found")
+    parser.add_argument('--timings', action='store_true', help="Log the time spent in each stage")
+    parser.add_argument('--log-level', default=os.environ.get('LOG_LEVEL', 'INFO'))
+    args = parser.parse_args(argv)
+    if args.output_dir is None and not args.check:
+        parser.error("the following arguments are required: -o/--output-dir")
+
+    logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    if args.timings:
+        logging.getLogger('instrumentation').setLevel(logging.INFO)
+
+    failures = 0
+    for path in find_inputs(args.inputs):
+        if args.check:
+            try:
+                failures += bool(check_input(manager, path, args.packaging_type, args.stream))
+            except OSError as e:
+                logger.error("%s: %s", path, e)
+                failures += 1
+            continue
+        with timed_run() if args.timings else nullcontext():
+            try:
+                count = generate_for_input(manager, path, args.output_dir, args.packaging_type, args.workers,
+                                           args.writer, args.single_workbook, args.zip, args.stream)
+            except OSError as e:
+                logger.error("%s: %s", path, e)
+                count = 0
+        if count:
+            logger.info("%s: wrote %d instructions", path, count)
+        else:
+            logger.error("%s: no instructions generated", path)
+            failures += 1
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
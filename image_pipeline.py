@@ -0,0 +1,175 @@
+"""Resample and encode pictures for the cell range they are shown in.
+
+Excel only scales a picture for display; the file still carries every pixel
+of the original. Before embedding, images are therefore resampled to the
+pixel box of their target range (times an optional DPI multiplier for
+sharper printing), encoded as PNG when they have transparency or few colours
+(labels, drawings) and as JPEG otherwise (photos). Pictures are identified
+by a hash of their content: the same logo or label repeated across a batch
+is decoded once and encoded once per box, and writers can share the encoded
+bytes between documents. Decoded bitmaps are only kept until they have been
+encoded, within ``DECODED_CACHE_BYTES``; the small encoded results are what
+stays cached.
+"""
+import hashlib
+import io
+import threading
+from collections import OrderedDict, namedtuple
+
+from PIL import Image as PILImage
+
+# Defaults used by the template manager
+DEFAULT_DPI_SCALE = 1.0
+DEFAULT_JPEG_QUALITY = 85
+
+# Pictures with at most this many distinct colours are kept lossless
+_PALETTE_COLORS = 256
+_CACHE_SIZE = 256
+
+# Memory the decoded pictures waiting to be encoded may take, estimated from their pixel size
+DECODED_CACHE_BYTES = 256 * 1024 * 1024
+
+# Key of ``PIL.Image.info`` holding the content hash of a decoded picture;
+# ``info`` travels with the image when it is pickled to worker processes
+DIGEST_KEY = 'content_digest'
+
+# Encoded picture: raw bytes, 'png' or 'jpeg', and the display size in pixels
+EncodedImage = namedtuple('EncodedImage', ['data', 'format', 'width', 'height'])
+
+# Decoded pictures by digest, with their estimated size, and the total of those sizes
+_decoded_cache = OrderedDict()
+_decoded_bytes = 0
+_decoded_lock = threading.Lock()
+# Encodings by picture and box; the app's threads share them like the decoded pictures
+_encoded_cache = OrderedDict()
+_encoded_lock = threading.Lock()
+
+
+def _remember(cache, key, value):
+    # A thread that encoded the same picture first keeps its bytes object
+    if key in cache:
+        cache.move_to_end(key)
+        return cache[key]
+    cache[key] = value
+    if len(cache) > _CACHE_SIZE:
+        cache.popitem(last=False)
+    return value
+
+
+def _decoded_size(pil_image):
+    return pil_image.width * pil_image.height * len(pil_image.getbands())
+
+
+def open_image(data):
+    """Decode the raw bytes of an embedded picture, once per distinct content until it is encoded"""
+    global _decoded_bytes
+    digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+    with _decoded_lock:
+        cached = _decoded_cache.get(digest)
+        if cached is not None:
+            _decoded_cache.move_to_end(digest)
+            return cached[0]
+    # Opening only reads the header; the pixels are decoded when first used
+    pil_image = PILImage.open(io.BytesIO(data))
+    pil_image.info[DIGEST_KEY] = digest
+    size = _decoded_size(pil_image)
+    with _decoded_lock:
+        if size <= DECODED_CACHE_BYTES and digest not in _decoded_cache:
+            _decoded_cache[digest] = (pil_image, size)
+            _decoded_bytes += size
+            while _decoded_bytes > DECODED_CACHE_BYTES:
+                _, (_, dropped) = _decoded_cache.popitem(last=False)
+                _decoded_bytes -= dropped
+    return pil_image
+
+
+def _forget_decoded(digest):
+    """Drop a decoded picture once it is encoded; its encodings are cached by digest"""
+    global _decoded_bytes
+    with _decoded_lock:
+        cached = _decoded_cache.pop(digest, None)
+        if cached is not None:
+            _decoded_bytes -= cached[1]
+
+
+def clear_caches():
+    """Forget every decoded and encoded picture, so the next requests start cold"""
+    global _decoded_bytes
+    with _decoded_lock:
+        _decoded_cache.clear()
+        _decoded_bytes = 0
+    with _encoded_lock:
+        _encoded_cache.clear()
+
+
+def image_digest(pil_image):
+    """Content hash of a picture: that of its file bytes, or else of its pixels"""
+    digest = pil_image.info.get(DIGEST_KEY)
+    if digest is None:
+        pixels = hashlib.blake2b(digest_size=16)
+        pixels.update(f"{pil_image.mode}{pil_image.size}".encode())
+        pixels.update(pil_image.tobytes())
+        digest = pil_image.info[DIGEST_KEY] = pixels.hexdigest()
+    return digest
+
+
+def fit_size(size, box_width, box_height):
+    """Largest (width, height) with the aspect ratio of ``size`` that fits the box"""
+    original_width, original_height = size
+    scale = min(box_width / original_width, box_height / original_height)
+    return int(original_width * scale), int(original_height * scale)
+
+
+def _has_alpha(pil_image):
+    return pil_image.mode in ('RGBA', 'LA', 'PA') or (
+        pil_image.mode == 'P' and 'transparency' in pil_image.info)
+
+
+def choose_format(pil_image):
+    """PNG for transparent or flat-colour pictures, JPEG for photographs"""
+    if _has_alpha(pil_image) or pil_image.mode in ('1', 'P'):
+        return 'png'
+    sample = pil_image if max(pil_image.size) <= 512 else pil_image.resize(
+        (min(pil_image.width, 512), min(pil_image.height, 512)), PILImage.NEAREST)
+    if sample.getcolors(_PALETTE_COLORS) is not None:
+        return 'png'
+    return 'jpeg'
+
+
+def encode_for_box(pil_image, box_width, box_height, dpi_scale=DEFAULT_DPI_SCALE,
+                   quality=DEFAULT_JPEG_QUALITY, digest=None):
+    """Resample and encode a picture for a box of ``box_width`` x ``box_height`` pixels.
+
+    The picture is displayed at the largest size that fits the box and
+    stored at ``dpi_scale`` times that size, never larger than the original.
+    ``digest`` identifies the picture in the cache; it defaults to
+    ``image_digest``. The same ``EncodedImage`` (and ``data`` bytes object)
+    is returned for every request of a picture and box still in the cache.
+    """
+    width, height = fit_size(pil_image.size, box_width, box_height)
+    key = (digest or image_digest(pil_image), width, height, dpi_scale, quality)
+    with _encoded_lock:
+        encoded = _encoded_cache.get(key)
+        if encoded is not None:
+            _encoded_cache.move_to_end(key)
+            return encoded
+
+    target = (max(1, min(pil_image.width, round(width * dpi_scale))),
+              max(1, min(pil_image.height, round(height * dpi_scale))))
+    picture = pil_image
+    if picture.mode not in ('1', 'L', 'LA', 'P', 'RGB', 'RGBA'):
+        picture = picture.convert('RGBA' if _has_alpha(picture) else 'RGB')
+    if target != picture.size:
+        picture = picture.resize(target, PILImage.LANCZOS, reducing_gap=3.0)
+
+    image_format = choose_format(picture)
+    buffer = io.BytesIO()
+    if image_format == 'jpeg':
+        picture.convert('RGB').save(buffer, format='JPEG', quality=quality, optimize=True)
+    else:
+        picture.save(buffer, format='PNG', optimize=True)
+
+    _forget_decoded(key[0])
+    encoded = EncodedImage(buffer.getvalue(), image_format, width, height)
+    with _encoded_lock:
+        return _remember(_encoded_cache, key, encoded)
@@ -0,0 +1,85 @@
+"""Per-stage wall-clock and memory timings of instruction generation.
+
+Code paths mark their stages with ``stage(name)``; the timings are only
+recorded while a ``RunTimings`` is active in the current context (one per
+Streamlit script run), otherwise ``stage`` costs next to nothing. Stages
+are meant to be consecutive, not nested: the memory peak of a stage is
+reset by any stage started inside it.
+"""
+import logging
+import time
+import tracemalloc
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+logger = logging.getLogger(__name__)
+
+# Stages reported by the generation pipeline, in pipeline order
+STAGES = ('parse', 'image extraction', 'skeleton build', 'populate', 'image embed', 'save')
+
+_current_run = ContextVar('current_run', default=None)
+
+
+class RunTimings:
+    """Accumulated timings of every stage of one run.
+
+    With ``track_memory`` the peak memory allocated inside each stage is
+    measured with ``tracemalloc``, which slows the run down noticeably.
+    """
+
+    def __init__(self, track_memory=False):
+        self.track_memory = track_memory
+        self.stages = {}
+
+    def record(self, name, seconds, peak_bytes=None):
+        entry = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'peak_kb': None})
+        entry['calls'] += 1
+        entry['seconds'] += seconds
+        if peak_bytes is not None:
+            entry['peak_kb'] = max(entry['peak_kb'] or 0, peak_bytes // 1024)
+
+    def as_dict(self):
+        """Timings per stage, pipeline stages first"""
+        ordered = [name for name in STAGES if name in self.stages]
+        ordered += [name for name in self.stages if name not in STAGES]
+        return {name: dict(self.stages[name]) for name in ordered}
+
+
+@contextmanager
+def stage(name):
+    """Time the enclosed block as one call of stage ``name`` of the active run"""
+    run = _current_run.get()
+    if run is None:
+        yield
+        return
+
+    tracking = run.track_memory and tracemalloc.is_tracing()
+    if tracking:
+        start_memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        peak_bytes = tracemalloc.get_traced_memory()[1] - start_memory if tracking else None
+        run.record(name, seconds, peak_bytes)
+        logger.debug("stage %s took %.1f ms", name, seconds * 1000)
+
+
+@contextmanager
+def timed_run(track_memory=False):
+    """Collect stage timings of everything run inside the block"""
+    run = RunTimings(track_memory)
+    token = _current_run.set(run)
+    started_tracing = track_memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    try:
+        yield run
+    finally:
+        if started_tracing:
+            tracemalloc.stop()
+        _current_run.reset(token)
+        if run.stages:
+            logger.info("run timings: %s", run.as_dict())
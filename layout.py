@@ -0,0 +1,343 @@
+"""Declarative layout of the packaging instruction sheet.
+
+The sheet is described once, as data: column widths and row heights, the
+styled blocks (a range, one of the named ``TEMPLATE_STYLES``, an optional
+text and whether the range is merged), the cells that receive a part's
+fields and procedure steps and the ranges that receive its images.
+
+``get_render_plan`` compiles the spec into a ``RenderPlan`` with the merge
+list, the resolved style of every cell as runs per row, the merged spans and
+the pixel geometry of the image ranges. The openpyxl template, the streaming
+OOXML writer and the HTML preview are all built from that plan, so they
+cannot drift apart.
+"""
+from collections import namedtuple
+
+from openpyxl.styles import PatternFill, Font, Border, Side, Alignment
+from openpyxl.styles.fonts import DEFAULT_FONT
+from openpyxl.utils import get_column_letter, range_boundaries
+
+# Bump whenever the layout spec, its styles or the way they are built change
+TEMPLATE_VERSION = 3
+
+# Style objects shared by every template; openpyxl style objects are immutable
+_THIN_SIDE = Side(style='thin')
+THIN_BORDER = Border(left=_THIN_SIDE, right=_THIN_SIDE, top=_THIN_SIDE, bottom=_THIN_SIDE)
+_BLUE_FILL = PatternFill(start_color="4472C4", end_color="4472C4", fill_type="solid")
+_RED_FILL = PatternFill(start_color="FF0000", end_color="FF0000", fill_type="solid")
+_LIGHT_BLUE_FILL = PatternFill(start_color="D6EAF8", end_color="D6EAF8", fill_type="solid")
+_NO_FILL = PatternFill()
+_WHITE_FONT = Font(color="FFFFFF", bold=True, size=12)
+_BLACK_FONT = Font(color="000000", bold=True, size=14)
+_REGULAR_FONT = Font(color="000000", size=12)
+_TITLE_FONT = Font(bold=True, size=12)
+_BOLD_FONT = Font(bold=True)
+_ARROW_FONT = Font(size=20, bold=True)
+_CENTER = Alignment(horizontal='center', vertical='center', wrap_text=True)
+_LEFT = Alignment(horizontal='left', vertical='center', wrap_text=True)
+_NO_ALIGNMENT = Alignment()
+
+# Named cell styles of the template as (font, fill, alignment), all with thin
+# borders. Registering them once per workbook lets a cell take its whole style
+# in one assignment instead of a lookup per font, fill, border and alignment.
+TEMPLATE_STYLES = {
+    'Instruction Banner': (_WHITE_FONT, _BLUE_FILL, _CENTER),
+    'Caution': (_WHITE_FONT, _RED_FILL, _CENTER),
+    'Section Title': (_TITLE_FONT, _NO_FILL, _CENTER),
+    'Field Label': (_BOLD_FONT, _NO_FILL, _LEFT),
+    'Column Header': (_BOLD_FONT, _NO_FILL, _CENTER),
+    'Total': (_BLACK_FONT, _NO_FILL, _CENTER),
+    'Remark': (_BLACK_FONT, _NO_FILL, _LEFT),
+    'Step Number': (_REGULAR_FONT, _NO_FILL, _CENTER),
+    'Step Text': (DEFAULT_FONT, _NO_FILL, _LEFT),
+    'Image Caption': (_REGULAR_FONT, _NO_FILL, _CENTER),
+    'Secondary Image Caption': (_REGULAR_FONT, _LIGHT_BLUE_FILL, _CENTER),
+    'Arrow': (_ARROW_FONT, _NO_FILL, _CENTER),
+    'Boxed': (DEFAULT_FONT, _NO_FILL, _NO_ALIGNMENT),
+}
+
+# Pixels per character of column width and per point of row height, and the
+# size assumed for columns and rows the layout leaves at their default
+PIXELS_PER_CHARACTER = 7.5
+PIXELS_PER_POINT = 1.33
+DEFAULT_COLUMN_WIDTH = 12
+DEFAULT_ROW_HEIGHT = 16
+# Images are fitted to 90% of their range so that they stay inside the borders
+IMAGE_PADDING = 0.9
+
+# A styled range of the sheet; ``value`` goes to its first cell. Later blocks
+# override the style of earlier ones where they overlap.
+Block = namedtuple('Block', ['range', 'style', 'value', 'merge'], defaults=(None, False))
+
+SHEET_TITLE = "Packaging Instruction"
+
+COLUMN_WIDTHS = {'A': 16, **{letter: 14 for letter in 'BCDEFGHIJK'}, 'L': 36}
+
+ROW_HEIGHTS = {row: 16 for row in range(1, 51)}
+
+# Column headers of the primary and secondary packaging tables
+_PACKAGING_HEADERS = ["Packaging Type", "L-mm", "W-mm", "H-mm", "Qty/Pack", "Empty Weight", "Pack Weight"]
+
+
+def _sheet_blocks():
+    blocks = [
+        # Header Row - "Packaging Instruction", Current Packaging header on the right
+        Block('A1:K1', 'Instruction Banner', "Packaging Instruction", merge=True),
+        Block('L1', 'Instruction Banner', "CURRENT PACKAGING"),
+
+        # Revision information row
+        Block('A2', 'Field Label', "Revision No."),
+        Block('B2:E2', 'Boxed', "01", merge=True),
+        Block('F2', 'Field Label', "Date"),
+        Block('G2:K2', 'Boxed', merge=True),
+        Block('L2', 'Boxed'),
+
+        # Row 4 - Section headers
+        Block('A4:D4', 'Section Title', "Vendor Information", merge=True),
+        Block('F4:I4', 'Section Title', "Part Information", merge=True),
+        Block('J4:L4', 'Boxed'),
+    ]
+
+    # Vendor (A-D) and part (F-L) fields, rows 5-7
+    for row, vendor_field, part_field in ((5, "Code", "Part No."), (6, "Name", "Description"),
+                                          (7, "Location", "Unit Weight")):
+        blocks += [
+            Block(f'A{row}', 'Field Label', vendor_field),
+            Block(f'B{row}:D{row}', 'Boxed', merge=True),
+            Block(f'F{row}', 'Field Label', part_field),
+            Block(f'G{row}:K{row}', 'Boxed', merge=True),
+            Block(f'L{row}', 'Boxed'),
+        ]
+
+    blocks += [
+        # Row 8 - L, W, H of the part
+        Block('A8:D8', 'Boxed'),
+        Block('F8', 'Field Label', "L"),
+        Block('G8', 'Boxed'),
+        Block('H8', 'Column Header', "W"),
+        Block('I8', 'Boxed'),
+        Block('J8', 'Column Header', "H"),
+        Block('K8:L8', 'Boxed'),
+
+        # Primary packaging, rows 10-14
+        Block('A10:K10', 'Instruction Banner', "Primary Packaging Instruction (Primary / Internal)", merge=True),
+        *(Block(f'{get_column_letter(col)}11', 'Column Header', header)
+          for col, header in enumerate(_PACKAGING_HEADERS, 1)),
+        Block('H11:L11', 'Boxed'),
+        Block('A12:L14', 'Boxed'),
+        Block('D14', 'Total', "TOTAL"),
+
+        # Secondary packaging, rows 16-20, with the remarks in column L
+        Block('A16:K16', 'Instruction Banner', "Secondary Packaging Instruction (Outer / External)", merge=True),
+        *(Block(f'{get_column_letter(col)}17', 'Column Header', header)
+          for col, header in enumerate(_PACKAGING_HEADERS, 1)),
+        Block('H17:K17', 'Boxed'),
+        Block('A18:K20', 'Boxed'),
+        Block('D20', 'Total', "TOTAL"),
+        Block('L18', 'Remark'),
+        Block('L19', 'Caution'),
+        Block('L20', 'Boxed'),
+
+        # Packaging procedure, steps in rows 23-33
+        Block('A22:K22', 'Instruction Banner', "Packaging Procedure", merge=True),
+    ]
+    for step in range(1, 12):
+        row = 22 + step
+        blocks += [
+            Block(f'A{row}', 'Step Number', str(step)),
+            Block(f'B{row}:K{row}', 'Step Text', merge=True),
+        ]
+
+    blocks += [
+        # Reference images, rows 35-42, with arrows between the image areas
+        Block('A35:K35', 'Instruction Banner', "Reference Images/Pictures", merge=True),
+        Block('A36:C36', 'Column Header', "Primary Packaging", merge=True),
+        Block('D36:G36', 'Column Header', "Secondary Packaging", merge=True),
+        Block('H36:K36', 'Column Header', "Label", merge=True),
+        Block('A37:C42', 'Image Caption', "Primary\nPackaging", merge=True),
+        Block('D37:D42', 'Boxed'),
+        Block('D40', 'Arrow', "→"),
+        Block('E37:F42', 'Secondary Image Caption', "SECONDARY\nPACKAGING", merge=True),
+        Block('G37:G42', 'Boxed'),
+        Block('G40', 'Arrow', "→"),
+        Block('H37:K42', 'Image Caption', "LABEL", merge=True),
+    ]
+
+    # Approval sections - rows 44 and 50, signature boxes below each
+    for header_row in (44, 50):
+        for columns, header in ((('A', 'C'), "Issued By"), (('D', 'G'), "Reviewed By"),
+                                (('H', 'K'), "Approved By")):
+            first, last = columns
+            blocks += [
+                Block(f'{first}{header_row}:{last}{header_row}', 'Column Header', header, merge=True),
+                Block(f'{first}{header_row + 1}:{last}{header_row + 4}', 'Boxed', merge=True),
+            ]
+    return blocks
+
+
+BLOCKS = _sheet_blocks()
+
+# Cells that receive the part's data
+FIELD_SLOTS = {
+    'Revision No.': 'B2',
+    'Date': 'G2',
+    'Vendor Code': 'B5',
+    'Vendor Name': 'B6',
+    'Vendor Location': 'B7',
+    'Part No.': 'G5',
+    'Part Description': 'G6',
+    'Part Unit Weight': 'G7',
+    'Part L': 'G8',
+    'Part W': 'I8',
+    'Part H': 'K8',
+    'Primary Packaging Type': 'A12',
+    'Primary L-mm': 'B12',
+    'Primary W-mm': 'C12',
+    'Primary H-mm': 'D12',
+    'Primary Qty/Pack': 'E12',
+    'Primary Empty Weight': 'F12',
+    'Primary Pack Weight': 'G12',
+    'Secondary Packaging Type': 'A18',
+    'Secondary L-mm': 'B18',
+    'Secondary W-mm': 'C18',
+    'Secondary H-mm': 'D18',
+    'Secondary Qty/Pack': 'E18',
+    'Secondary Empty Weight': 'F18',
+    'Secondary Pack Weight': 'G18',
+    'Problem If Any': 'L19',
+    'Issued By': 'A45',
+    'Reviewed By': 'D45',
+    'Approved By': 'H45',
+    'Caution': 'L20',
+}
+
+# Procedure steps fill rows 23-33 of column B
+PROCEDURE_SLOTS = {f'Procedure Step {step}': f'B{22 + step}' for step in range(1, 12)}
+
+# Cell ranges that receive the reference images, in placement order
+IMAGE_SLOTS = {
+    'Primary Packaging': 'A37:C42',
+    'Secondary Packaging': 'E37:F42',
+    'Label': 'H37:K42',
+    'Current Packaging': 'L2:L17',
+}
+
+# Image range of the plan: its first cell (1-based ``column`` and ``row``),
+# the pixel offset of that cell from the top left of the sheet and the pixel
+# box an image is fitted to
+ImageSlot = namedtuple('ImageSlot', ['cell_range', 'column', 'row', 'left', 'top', 'box'])
+
+RenderPlan = namedtuple('RenderPlan', [
+    'title',
+    'max_row',
+    'max_column',
+    'column_widths',   # {column letter: width in characters}, as in the spec
+    'row_heights',     # {row: height in points}, as in the spec
+    'column_pixels',   # pixel width of every column 1..max_column
+    'row_pixels',      # pixel height of every row 1..max_row
+    'merges',          # merged ranges, in spec order
+    'spans',           # {(row, column): (colspan, rowspan)} of the merged ranges
+    'covered',         # (row, column) of the cells hidden by a merge
+    'style_runs',      # {row: ((first column, last column, style), ...)}
+    'values',          # {coordinate: text} of the fixed cells
+    'field_slots',
+    'procedure_slots',
+    'slot_cells',      # every cell a part's data may fill
+    'image_slots',     # {category: ImageSlot}
+])
+
+_render_plan = None
+
+
+def range_box(column_widths, row_heights, cell_range):
+    """Pixel (width, height) an image is fitted to over a range of the layout"""
+    min_col, min_row, max_col, max_row = range_boundaries(cell_range)
+    width = 0
+    for col in range(min_col, max_col + 1):
+        width += (column_widths.get(get_column_letter(col)) or DEFAULT_COLUMN_WIDTH) * PIXELS_PER_CHARACTER
+    height = 0
+    for row in range(min_row, max_row + 1):
+        height += (row_heights.get(row) or DEFAULT_ROW_HEIGHT) * PIXELS_PER_POINT
+    return width * IMAGE_PADDING, height * IMAGE_PADDING
+
+
+def _style_runs(cell_styles):
+    """Group the resolved style of every cell into runs of adjacent columns per row"""
+    runs = {}
+    for (row, col), style in sorted(cell_styles.items()):
+        row_runs = runs.setdefault(row, [])
+        if row_runs and row_runs[-1][1] == col - 1 and row_runs[-1][2] == style:
+            row_runs[-1][1] = col
+        else:
+            row_runs.append([col, col, style])
+    return {row: tuple(tuple(run) for run in row_runs) for row, row_runs in runs.items()}
+
+
+def compile_layout(blocks=BLOCKS, column_widths=COLUMN_WIDTHS, row_heights=ROW_HEIGHTS, field_slots=FIELD_SLOTS,
+                   procedure_slots=PROCEDURE_SLOTS, image_slots=IMAGE_SLOTS, title=SHEET_TITLE):
+    """Compile a layout spec into a ``RenderPlan``"""
+    cell_styles = {}
+    values = {}
+    merges = []
+    spans = {}
+    covered = set()
+    max_row = max_column = 1
+    for block in blocks:
+        if block.style not in TEMPLATE_STYLES:
+            raise ValueError(f"Unknown template style {block.style!r} for {block.range}")
+        min_col, min_row, max_col, last_row = range_boundaries(block.range)
+        max_row, max_column = max(max_row, last_row), max(max_column, max_col)
+        for row in range(min_row, last_row + 1):
+            for col in range(min_col, max_col + 1):
+                cell_styles[(row, col)] = block.style
+        if block.value is not None:
+            values[f'{get_column_letter(min_col)}{min_row}'] = block.value
+        if block.merge:
+            merges.append(block.range)
+            spans[(min_row, min_col)] = (max_col - min_col + 1, last_row - min_row + 1)
+            covered.update((row, col) for row in range(min_row, last_row + 1)
+                           for col in range(min_col, max_col + 1) if (row, col) != (min_row, min_col))
+
+    slot_cells = frozenset(field_slots.values()) | frozenset(procedure_slots.values())
+    unstyled = sorted(cell for cell in slot_cells
+                      if tuple(reversed(range_boundaries(cell)[:2])) not in cell_styles)
+    if unstyled:
+        raise ValueError(f"Slot cells {', '.join(unstyled)} are not part of any block")
+
+    column_pixels = [(column_widths.get(get_column_letter(col)) or DEFAULT_COLUMN_WIDTH) * PIXELS_PER_CHARACTER
+                     for col in range(1, max_column + 1)]
+    row_pixels = [(row_heights.get(row) or DEFAULT_ROW_HEIGHT) * PIXELS_PER_POINT
+                  for row in range(1, max_row + 1)]
+    plan_images = {}
+    for category, cell_range in image_slots.items():
+        min_col, min_row, _, _ = range_boundaries(cell_range)
+        plan_images[category] = ImageSlot(cell_range, min_col, min_row, sum(column_pixels[:min_col - 1]),
+                                          sum(row_pixels[:min_row - 1]),
+                                          range_box(column_widths, row_heights, cell_range))
+
+    return RenderPlan(
+        title=title,
+        max_row=max_row,
+        max_column=max_column,
+        column_widths=dict(column_widths),
+        row_heights=dict(row_heights),
+        column_pixels=column_pixels,
+        row_pixels=row_pixels,
+        merges=tuple(merges),
+        spans=spans,
+        covered=frozenset(covered),
+        style_runs=_style_runs(cell_styles),
+        values=values,
+        field_slots=dict(field_slots),
+        procedure_slots=dict(procedure_slots),
+        slot_cells=slot_cells,
+        image_slots=plan_images,
+    )
+
+
+def get_render_plan():
+    """Return the render plan of the instruction sheet, compiling it only once"""
+    global _render_plan
+    if _render_plan is None:
+        _render_plan = compile_layout()
+    return _render_plan
@@ -0,0 +1,364 @@
+"""Write instruction workbooks straight to OOXML, bypassing the openpyxl object model.
+
+The template skeleton is saved once by openpyxl and split into pre-rendered
+fragments: every fixed part of the package is kept as bytes and the sheet XML
+is cut around the cells that receive a part's data. Rendering a document then
+only formats those cells and the embedded images and streams everything into
+the zip, producing the same cell XML openpyxl would write.
+"""
+import io
+import logging
+import re
+import zipfile
+from datetime import datetime, timezone
+from xml.sax.saxutils import escape, quoteattr
+
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+from openpyxl.compat import safe_string
+
+from image_pipeline import encode_for_box
+from instrumentation import stage
+from layout import TEMPLATE_VERSION, get_render_plan
+
+logger = logging.getLogger(__name__)
+
+SHEET_PART = 'xl/worksheets/sheet1.xml'
+CORE_PART = 'docProps/core.xml'
+CONTENT_TYPES_PART = '[Content_Types].xml'
+
+_WORKBOOK_PART = 'xl/workbook.xml'
+_SHEET_PATTERN = 'xl/worksheets/sheet{}.xml'
+_DRAWING_PATTERN = 'xl/drawings/drawing{}.xml'
+_SHEET_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml'
+_DRAWING_TYPE = 'application/vnd.openxmlformats-officedocument.drawing+xml'
+_RELS_NS = 'http://schemas.openxmlformats.org/package/2006/relationships'
+_DOC_RELS_NS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+_EMU_PER_PIXEL = 9525
+_MAX_CELL_TEXT = 32767
+
+# Compiled sheet templates, keyed by template version
+_compiled_sheets = {}
+
+
+def get_compiled_sheet(manager):
+    """Return the compiled sheet template, compiling it only once per version"""
+    sheet = _compiled_sheets.get(TEMPLATE_VERSION)
+    if sheet is None:
+        sheet = CompiledSheet(manager)
+        _compiled_sheets[TEMPLATE_VERSION] = sheet
+    return sheet
+
+
+def cell_xml(coordinate, style_id, value):
+    """Serialize one cell exactly as openpyxl writes it"""
+    style = f' s="{style_id}"' if style_id is not None else ''
+    if isinstance(value, bool):
+        return f'<c r="{coordinate}"{style} t="b"><v>{int(value)}</v></c>'
+    if isinstance(value, (int, float)):
+        return f'<c r="{coordinate}"{style} t="n"><v>{safe_string(value)}</v></c>'
+    if not isinstance(value, str):
+        raise ValueError(f"Cannot convert {value!r} to Excel")
+    if ILLEGAL_CHARACTERS_RE.search(value):
+        raise ValueError(f"Illegal character in {value!r}")
+    value = value[:_MAX_CELL_TEXT]
+    if value.startswith('=') and len(value) > 1:
+        return f'<c r="{coordinate}"{style}><f>{escape(value[1:])}</f><v /></c>'
+    space = ' xml:space="preserve"' if value.strip() and value != value.strip() else ''
+    return f'<c r="{coordinate}"{style} t="inlineStr"><is><t{space}>{escape(value)}</t></is></c>'
+
+
+def _rels_part(part):
+    folder, name = part.rsplit('/', 1)
+    return f'{folder}/_rels/{name}.rels'
+
+
+def _drawing_anchor(index, col, row, width, height):
+    return (
+        f'<oneCellAnchor><from><col>{col}</col><colOff>0</colOff><row>{row}</row><rowOff>0</rowOff></from>'
+        f'<ext cx="{width * _EMU_PER_PIXEL}" cy="{height * _EMU_PER_PIXEL}" />'
+        f'<pic><nvPicPr><cNvPr id="{index}" name="Image {index}" descr="Picture" /><cNvPicPr /></nvPicPr>'
+        f'<blipFill><a:blip cstate="print" r:embed="rId{index}" /><a:stretch><a:fillRect /></a:stretch></blipFill>'
+        f'<spPr><a:prstGeom prst="rect" /></spPr></pic><clientData /></oneCellAnchor>'
+    )
+
+
+def _drawing_xml(anchors):
+    return (
+        '<wsDr xmlns:a="http://schemas.openxmlformats.org/drawingml/2006/main" '
+        f'xmlns:r="{_DOC_RELS_NS}" '
+        'xmlns="http://schemas.openxmlformats.org/drawingml/2006/spreadsheetDrawing">'
+        + ''.join(anchors) + '</wsDr>'
+    )
+
+
+def _relationships_xml(targets, rel_type):
+    rels = ''.join(
+        f'<Relationship Type="{_DOC_RELS_NS}/{rel_type}" Target="{target}" Id="rId{index}" />'
+        for index, target in enumerate(targets, 1)
+    )
+    return f'<Relationships xmlns="{_RELS_NS}">{rels}</Relationships>'
+
+
+def _split_timestamps(core_xml):
+    """Cut docProps/core.xml around its created/modified timestamps"""
+    pattern = re.compile(r'(<dcterms:(?:created|modified)[^>]*>)[^<]*(</dcterms:)')
+    fragments = []
+    position = 0
+    for match in pattern.finditer(core_xml):
+        fragments.append(core_xml[position:match.end(1)])
+        position = match.start(2)
+    fragments.append(core_xml[position:])
+    return fragments
+
+
+class CompiledSheet:
+    """Pre-rendered parts of the instruction template, ready to be streamed.
+
+    The skeleton built by ``get_template_workbook`` is saved once; the sheet
+    XML is split around the slot cells of the layout's render plan, whose
+    image slots give the anchor and pixel box of each image range, so
+    rendering a document never touches an openpyxl ``Workbook``.
+    """
+
+    def __init__(self, manager):
+        self.manager = manager
+        plan = get_render_plan()
+        wb = manager.get_template_workbook()
+        buffer = io.BytesIO()
+        wb.save(buffer)
+
+        with zipfile.ZipFile(buffer) as archive:
+            self.parts = {name: archive.read(name) for name in archive.namelist()}
+
+        sheet_xml = self.parts.pop(SHEET_PART).decode('utf-8')
+        self.core_fragments = _split_timestamps(self.parts.pop(CORE_PART).decode('utf-8'))
+        self.content_types = self.parts.pop(CONTENT_TYPES_PART).decode('utf-8')
+
+        # Cut the sheet around the variable cells, in document order
+        slots = []
+        for coordinate in plan.slot_cells:
+            match = re.search(rf'<c r="{coordinate}"(?: s="(\d+)")?[^>]*?(?: />|>.*?</c>)', sheet_xml)
+            if match is None:
+                raise ValueError(f"Template cell {coordinate} not found in the skeleton sheet")
+            slots.append((match.start(), match.end(), coordinate, match.group(1), match.group(0)))
+        slots.sort()
+
+        self.sheet_fragments = []
+        self.slots = []
+        position = 0
+        for start, end, coordinate, style_id, empty_xml in slots:
+            self.sheet_fragments.append(sheet_xml[position:start])
+            self.slots.append((coordinate, style_id, empty_xml))
+            position = end
+        # The drawing reference, when present, goes right before the closing tag
+        self.sheet_tail = sheet_xml[position:].rsplit('</worksheet>', 1)[0]
+
+        # Pixel box and 0-based anchor of every image range
+        self.image_slots = {
+            category: (slot.column - 1, slot.row - 1, slot.box) for category, slot in plan.image_slots.items()
+        }
+
+    def patch(self, content, previous_data, data_dict, fileobj=None):
+        """Rewrite only the cells that differ between two parts' data in a rendered instruction.
+
+        ``content`` is an instruction rendered for ``previous_data`` by either
+        writer. The cells whose value changes (such as the procedure steps
+        and packaging type when another procedure is picked) are replaced in
+        the sheet XML; every other part, images included, is copied as is.
+        """
+        before = self.manager.variable_cell_values(previous_data)
+        after = self.manager.variable_cell_values(data_dict)
+        changed = sorted(coordinate for coordinate in set(before) | set(after)
+                         if before.get(coordinate) != after.get(coordinate))
+        if not changed and fileobj is None:
+            return content
+
+        empty_cells = {coordinate: empty_xml for coordinate, _, empty_xml in self.slots}
+        pattern = re.compile(rf'<c r="({"|".join(changed)})"(?: s="(\d+)")?[^>]*?(?: />|>.*?</c>)')
+
+        def replace(match):
+            coordinate, style_id = match.group(1), match.group(2)
+            if coordinate in after:
+                try:
+                    return cell_xml(coordinate, style_id, after[coordinate])
+                except ValueError as e:
+                    logger.warning("Error populating cell %s: %s", coordinate, e)
+            return empty_cells[coordinate]
+
+        target = fileobj if fileobj is not None else io.BytesIO()
+        with stage('patch'), zipfile.ZipFile(io.BytesIO(content)) as source, \
+                zipfile.ZipFile(target, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for info in source.infolist():
+                data = source.read(info)
+                if info.filename == SHEET_PART:
+                    data = pattern.sub(replace, data.decode('utf-8'))
+                archive.writestr(info, data)
+
+        if fileobj is None:
+            return target.getvalue()
+        return fileobj
+
+    def _sheet_xml(self, cell_values, has_drawing):
+        pieces = []
+        for fragment, (coordinate, style_id, empty_xml) in zip(self.sheet_fragments, self.slots):
+            pieces.append(fragment)
+            if coordinate in cell_values:
+                try:
+                    pieces.append(cell_xml(coordinate, style_id, cell_values[coordinate]))
+                    continue
+                except ValueError as e:
+                    logger.warning("Error populating cell %s: %s", coordinate, e)
+            pieces.append(empty_xml)
+        pieces.append(self.sheet_tail)
+        if has_drawing:
+            pieces.append(f'<drawing xmlns:r="{_DOC_RELS_NS}" r:id="rId1" />')
+        pieces.append('</worksheet>')
+        return ''.join(pieces)
+
+    def _core_xml(self):
+        stamp = datetime.now(tz=timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        return stamp.join(self.core_fragments)
+
+    def _content_types_xml(self, image_formats, sheets):
+        """Content types with the image extensions and, for every sheet
+        number of ``sheets``, its worksheet and drawing overrides"""
+        head, tail = self.content_types.rsplit('</Types>', 1)
+        # openpyxl lists the image extensions after its own defaults, in media order
+        defaults = ''.join(
+            f'<Default Extension="{extension}" ContentType="image/{extension}" />'
+            for extension in image_formats if f'Extension="{extension}"' not in head
+        )
+        head = head.replace('<Override ', defaults + '<Override ', 1)
+        sheet_override = re.search(rf'<Override PartName="/{SHEET_PART}"[^>]*/>', head)
+        overrides = []
+        for number, has_drawing in sheets:
+            overrides.append(f'<Override PartName="/{_SHEET_PATTERN.format(number)}" ContentType="{_SHEET_TYPE}" />')
+            if has_drawing:
+                overrides.append(f'<Override PartName="/{_DRAWING_PATTERN.format(number)}" ContentType="{_DRAWING_TYPE}" />')
+        return head[:sheet_override.start()] + ''.join(overrides) + head[sheet_override.end():] + '</Types>' + tail
+
+    def _images(self, images_data):
+        """Resample and encode the images for their ranges as add_image_to_cell_range does"""
+        images = []
+        for category, (col, row, (box_width, box_height)) in self.image_slots.items():
+            pil_image = (images_data or {}).get(category)
+            if not pil_image:
+                continue
+            try:
+                encoded = encode_for_box(pil_image, box_width, box_height,
+                                         self.manager.image_dpi_scale, self.manager.image_quality)
+            except Exception as e:
+                logger.warning("Error adding image to %s range: %s", category, e)
+                continue
+            images.append((col, row, encoded))
+        return images
+
+    def _write_sheet(self, archive, number, data_dict, images_data, media):
+        """Write worksheet ``number`` and its drawing into ``archive``.
+
+        ``media`` maps the encoded bytes of every picture already in the
+        package to its part name; a picture is only written the first time
+        it is seen, later sheets point their drawing at the same part.
+        Returns whether the sheet has a drawing.
+        """
+        with stage('image embed'):
+            images = self._images(images_data)
+        with stage('populate'):
+            cell_values = self.manager.variable_cell_values(data_dict)
+            sheet_xml = self._sheet_xml(cell_values, bool(images))
+
+        with stage('save'):
+            sheet_part = _SHEET_PATTERN.format(number)
+            archive.writestr(sheet_part, sheet_xml)
+            if not images:
+                return False
+            targets = []
+            for _, _, encoded in images:
+                name = media.get(encoded.data)
+                if name is None:
+                    name = media[encoded.data] = f'/xl/media/image{len(media) + 1}.{encoded.format}'
+                    archive.writestr(name.lstrip('/'), encoded.data)
+                targets.append(name)
+            anchors = [
+                _drawing_anchor(index, col, row, encoded.width, encoded.height)
+                for index, (col, row, encoded) in enumerate(images, 1)
+            ]
+            drawing_part = _DRAWING_PATTERN.format(number)
+            archive.writestr(drawing_part, _drawing_xml(anchors))
+            archive.writestr(_rels_part(drawing_part), _relationships_xml(targets, 'image'))
+            archive.writestr(_rels_part(sheet_part), _relationships_xml([f'/{drawing_part}'], 'drawing'))
+        return True
+
+    def _image_formats(self, media):
+        return dict.fromkeys(name.rsplit('.', 1)[-1] for name in media.values())
+
+    def render(self, data_dict, images_data=None, fileobj=None):
+        """Stream the instruction of one part into ``fileobj``, or return its bytes"""
+        target = fileobj if fileobj is not None else io.BytesIO()
+        with zipfile.ZipFile(target, 'w', zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr(CORE_PART, self._core_xml())
+            media = {}
+            has_drawing = self._write_sheet(archive, 1, data_dict, images_data, media)
+            with stage('save'):
+                for name, data in self.parts.items():
+                    archive.writestr(name, data)
+                archive.writestr(CONTENT_TYPES_PART,
+                                 self._content_types_xml(self._image_formats(media), [(1, has_drawing)]))
+
+        if fileobj is None:
+            return target.getvalue()
+        return fileobj
+
+    def render_workbook(self, sheets, fileobj=None):
+        """Stream one workbook holding a sheet per part into ``fileobj``, or return its bytes.
+
+        ``sheets`` yields ``(title, data_dict, images_data)`` and is consumed
+        lazily, one sheet at a time. Each distinct picture is stored once as
+        a media part shared by every sheet that shows it.
+        """
+        target = fileobj if fileobj is not None else io.BytesIO()
+        with zipfile.ZipFile(target, 'w', zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr(CORE_PART, self._core_xml())
+            media = {}
+            written = []
+            for number, (title, data_dict, images_data) in enumerate(sheets, 1):
+                written.append((number, title, self._write_sheet(archive, number, data_dict, images_data, media)))
+
+            with stage('save'):
+                parts = dict(self.parts)
+                parts[_WORKBOOK_PART] = self._workbook_xml([title for _, title, _ in written])
+                parts[_rels_part(_WORKBOOK_PART)] = self._workbook_rels_xml(len(written))
+                for name, data in parts.items():
+                    archive.writestr(name, data)
+                archive.writestr(CONTENT_TYPES_PART, self._content_types_xml(
+                    self._image_formats(media), [(number, has_drawing) for number, _, has_drawing in written]))
+
+        if fileobj is None:
+            return target.getvalue()
+        return fileobj
+
+    def _workbook_xml(self, titles):
+        workbook_xml = self.parts[_WORKBOOK_PART].decode('utf-8')
+        entry = re.search(r'<sheet [^>]*/>', workbook_xml)
+        sheets = ''.join(
+            re.sub(r'name="[^"]*" sheetId="\d+"(.*)r:id="rId\d+"',
+                   lambda match: f'name={quoteattr(title)} sheetId="{number}"{match.group(1)}r:id="rId{number}"',
+                   entry.group(0))
+            for number, title in enumerate(titles, 1)
+        )
+        return workbook_xml[:entry.start()] + sheets + workbook_xml[entry.end():]
+
+    def _workbook_rels_xml(self, sheet_count):
+        """Workbook relationships: the sheets first, then the template's other parts"""
+        rels_xml = self.parts[_rels_part(_WORKBOOK_PART)].decode('utf-8')
+        others = [
+            (rel_type, target)
+            for rel_type, target in re.findall(r'Type="([^"]+)" Target="([^"]+)"', rels_xml)
+            if not rel_type.endswith('/worksheet')
+        ]
+        rels = [(f'{_DOC_RELS_NS}/worksheet', f'/{_SHEET_PATTERN.format(number)}')
+                for number in range(1, sheet_count + 1)] + others
+        return f'<Relationships xmlns="{_RELS_NS}">' + ''.join(
+            f'<Relationship Type="{rel_type}" Target="{target}" Id="rId{index}" />'
+            for index, (rel_type, target) in enumerate(rels, 1)
+        ) + '</Relationships>'
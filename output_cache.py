@@ -0,0 +1,144 @@
+"""Persistent cache of generated instruction workbooks, addressed by content.
+
+A workbook is fully determined by the values written into the template
+cells, the pictures placed over the image ranges, the packaging type, the
+template version and the image encoding settings. ``output_key`` hashes
+exactly those, so the same part generated again, in any session or on
+another day, is served from disk without building a workbook.
+
+Entries are written atomically (to a temporary file renamed into place), so
+concurrent sessions and processes never read a partial file. When the cache
+grows past ``max_bytes`` the least recently used entries are evicted; a hit
+refreshes the entry's modification time. Any disk error only turns into a
+cache miss.
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+from image_pipeline import image_digest
+from instrumentation import stage
+from layout import TEMPLATE_VERSION
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'packaging_instructions')
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+_SUFFIX = '.xlsx'
+
+
+def _typed(value):
+    """JSON stand-in for a cell value that keeps its type, since 12 and '12' render differently"""
+    return f'{type(value).__name__}:{value}'
+
+
+def output_key(manager, form_data, images_data=None, procedure_type=None):
+    """Content hash of the workbook ``manager`` generates for a part"""
+    key = hashlib.blake2b(digest_size=20)
+    key.update(json.dumps({
+        'template_version': TEMPLATE_VERSION,
+        'procedure_type': procedure_type,
+        'image_settings': [manager.image_dpi_scale, manager.image_quality],
+        # The cells actually written, so that unused and empty fields do not split the cache
+        'cells': manager.variable_cell_values(form_data),
+        'images': {
+            category: image_digest(pil_image)
+            for category, pil_image in (images_data or {}).items() if pil_image
+        },
+    }, sort_keys=True, default=_typed).encode('utf-8'))
+    return key.hexdigest()
+
+
+class OutputCache:
+    """Generated workbooks stored as ``<key>.xlsx`` files below ``directory``"""
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + _SUFFIX)
+
+    def get(self, key):
+        """Stored bytes of ``key``, None on a miss"""
+        path = self._path(key)
+        try:
+            with stage('output cache'), open(path, 'rb') as handle:
+                content = handle.read()
+            # Mark the entry as recently used for the eviction order
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except OSError as e:
+            logger.warning("Error reading cached workbook %s: %s", path, e)
+            self.misses += 1
+            return None
+        self.hits += 1
+        return content
+
+    def put(self, key, content):
+        """Store ``content`` under ``key`` atomically, then evict down to ``max_bytes``"""
+        try:
+            handle, temporary = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            try:
+                with os.fdopen(handle, 'wb') as output:
+                    output.write(content)
+                os.replace(temporary, self._path(key))
+            except BaseException:
+                os.remove(temporary)
+                raise
+        except OSError as e:
+            logger.warning("Error caching workbook %s: %s", key, e)
+            return
+        self.evict()
+
+    def get_or_create(self, key, create):
+        """Stored bytes of ``key``, else the bytes returned by ``create()``, stored on the way"""
+        content = self.get(key)
+        if content is None:
+            content = create()
+            self.put(key, content)
+        return content
+
+    def entries(self):
+        """(modification time, size, path) of every stored workbook, least recently used first"""
+        entries = []
+        with os.scandir(self.directory) as scan:
+            for entry in scan:
+                if not entry.name.endswith(_SUFFIX):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    # Evicted by another process meanwhile
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+        return entries
+
+    def evict(self):
+        """Delete the least recently used workbooks until the cache fits ``max_bytes``"""
+        try:
+            entries = self.entries()
+        except OSError as e:
+            logger.warning("Error scanning the workbook cache %s: %s", self.directory, e)
+            return
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning("Error evicting cached workbook %s: %s", path, e)
+                continue
+            total -= size
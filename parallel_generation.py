@@ -0,0 +1,140 @@
+"""Spread per-part workbook generation across a pool of worker processes."""
+import io
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from itertools import islice
+
+from template_manager import ExactPackagingTemplateManager
+from instrumentation import stage
+from ooxml_writer import get_compiled_sheet
+
+# Available workbook writer backends
+WRITERS = ('openpyxl', 'ooxml')
+
+# Workers are never forked from the threaded app server: a forked child
+# inherits the locks other threads held at that moment, logging's and the
+# import lock among them, and can wait on them forever
+START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+# Per-process state, set up once by the pool initializer
+_worker_manager = None
+_worker_job = None
+
+
+def _init_worker(procedure_type, images_data, writer, row_images=None):
+    """Build one template manager per worker and remember the shared job settings"""
+    global _worker_manager, _worker_job
+    _worker_manager = ExactPackagingTemplateManager()
+    _worker_job = (procedure_type, images_data, writer, row_images)
+
+
+def _render_part(manager, index, form_data, images_data, writer='openpyxl'):
+    """Serialize the instruction workbook of one part from its form data"""
+    if writer == 'ooxml':
+        content = get_compiled_sheet(manager).render(form_data, images_data)
+    else:
+        wb = manager.populate_template_with_data(manager.get_template_workbook(), form_data, None, images_data)
+        buffer = io.BytesIO()
+        with stage('save'):
+            wb.save(buffer)
+        content = buffer.getvalue()
+    return index, manager.batch_file_name(form_data, index), content
+
+
+def _render_records(manager, chunk, procedure_type, images_data, writer, row_images=None):
+    """Render a chunk of (index, record) pairs, filling their procedure steps in one pass"""
+    indexes = [index for index, _ in chunk]
+    batch = manager.build_batch_form_data((record for _, record in chunk), procedure_type)
+    return [
+        _render_part(manager, index, form_data, manager.images_for_record(form_data, images_data, row_images), writer)
+        for index, form_data in zip(indexes, batch)
+    ]
+
+
+def _render_chunk(chunk):
+    """Worker entry point: render a chunk of (index, record) pairs"""
+    return _render_records(_worker_manager, chunk, *_worker_job)
+
+
+def _chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class ParallelGenerator:
+    """Generate instruction workbooks for many parts on a process pool.
+
+    Records are numbered from 1 and submitted in chunks of ``chunksize`` so
+    that the per-task pickling overhead is amortised. At most
+    ``max_pending`` chunks are in flight at any time, which keeps memory
+    bounded even when ``records`` is a lazy iterator. Results are yielded as
+    ``(index, file_name, xlsx_bytes)`` either in input order (``ordered``)
+    or as soon as each chunk completes. ``row_images`` (see
+    ``assign_row_images``) gives each part the pictures of its own sheet
+    row instead of the shared ``images_data``; both are best passed as raw
+    picture bytes (see ``decode_images``), which workers open per part as
+    they render it. ``writer`` selects the backend:
+    ``'openpyxl'`` populates a workbook clone, ``'ooxml'`` streams the
+    pre-rendered template parts straight into the zip. Worker processes
+    are started with ``START_METHOD`` unless ``mp_context`` says otherwise.
+    """
+
+    def __init__(self, max_workers=None, chunksize=8, ordered=True, max_pending=None, mp_context=None,
+                 writer='openpyxl'):
+        if writer not in WRITERS:
+            raise ValueError(f"Unknown writer {writer!r}, expected one of {WRITERS}")
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.chunksize = max(1, chunksize)
+        self.ordered = ordered
+        self.max_pending = max_pending or self.max_workers * 2
+        self.mp_context = mp_context or multiprocessing.get_context(START_METHOD)
+        self.writer = writer
+
+    def generate(self, records, procedure_type=None, images_data=None, row_images=None):
+        """Yield (index, file_name, xlsx_bytes) for every part record"""
+        numbered = enumerate(records, 1)
+        if self.max_workers == 1:
+            yield from self._generate_serial(numbered, procedure_type, images_data, row_images)
+            return
+
+        with ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            mp_context=self.mp_context,
+            initializer=_init_worker,
+            initargs=(procedure_type, images_data, self.writer, row_images),
+        ) as executor:
+            chunks = _chunked(numbered, self.chunksize)
+            pending = deque()
+            for chunk in islice(chunks, self.max_pending):
+                pending.append(executor.submit(_render_chunk, chunk))
+
+            try:
+                while pending:
+                    if self.ordered:
+                        done = [pending.popleft()]
+                    else:
+                        finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        done = [future for future in pending if future in finished]
+                        for future in done:
+                            pending.remove(future)
+
+                    for future in done:
+                        # Refill before yielding so workers stay busy while the caller consumes
+                        for chunk in islice(chunks, 1):
+                            pending.append(executor.submit(_render_chunk, chunk))
+                        yield from future.result()
+            finally:
+                # A caller that stops early (a cancelled job) only waits for the chunks already running
+                for future in pending:
+                    future.cancel()
+
+    def _generate_serial(self, numbered, procedure_type, images_data, row_images):
+        manager = ExactPackagingTemplateManager()
+        for chunk in _chunked(numbered, self.chunksize):
+            yield from _render_records(manager, chunk, procedure_type, images_data, self.writer, row_images)
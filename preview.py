@@ -0,0 +1,158 @@
+"""Render the instruction layout as HTML for a quick preview.
+
+The layout's render plan is turned once into an HTML table (column widths,
+row heights, merged spans and the CSS of every named style) cut around the
+slot cells that receive a part's data, much like ``ooxml_writer`` cuts the
+sheet XML. Previewing a part then only escapes its values into those cells
+and lays the images over their ranges, without building or saving a workbook.
+"""
+import base64
+from html import escape
+
+from openpyxl.styles import Alignment
+from openpyxl.styles.borders import DEFAULT_BORDER
+from openpyxl.styles.fills import DEFAULT_EMPTY_FILL
+from openpyxl.styles.fonts import DEFAULT_FONT
+from openpyxl.utils import get_column_letter
+
+from image_pipeline import encode_for_box
+from instrumentation import stage
+from layout import TEMPLATE_STYLES, TEMPLATE_VERSION, THIN_BORDER, get_render_plan
+
+# Compiled previews, keyed by template version
+_compiled_previews = {}
+
+
+def get_compiled_preview(manager):
+    """Return the compiled preview of the template, compiling it only once per version"""
+    preview = _compiled_previews.get(TEMPLATE_VERSION)
+    if preview is None:
+        preview = CompiledPreview(manager)
+        _compiled_previews[TEMPLATE_VERSION] = preview
+    return preview
+
+
+def _rgb(color):
+    """CSS colour of an openpyxl colour, None for theme and indexed colours"""
+    if color is None or color.type != 'rgb' or not isinstance(color.rgb, str):
+        return None
+    return f'#{color.rgb[-6:]}'
+
+
+def _style_css(font, fill, alignment, border):
+    styles = []
+    if fill.fill_type == 'solid' and _rgb(fill.fgColor):
+        styles.append(f'background:{_rgb(fill.fgColor)}')
+    if font.b:
+        styles.append('font-weight:bold')
+    if font.sz:
+        styles.append(f'font-size:{font.sz}pt')
+    if _rgb(font.color) and _rgb(font.color) != '#000000':
+        styles.append(f'color:{_rgb(font.color)}')
+    if alignment.horizontal:
+        styles.append(f'text-align:{alignment.horizontal}')
+    if alignment.vertical:
+        styles.append(f"vertical-align:{'middle' if alignment.vertical == 'center' else alignment.vertical}")
+    for side in ('left', 'right', 'top', 'bottom'):
+        if getattr(border, side).style:
+            styles.append(f'border-{side}:1px solid #000')
+    return ';'.join(styles)
+
+
+# CSS of every named template style, and of the cells the layout leaves unstyled
+_STYLE_CSS = {
+    name: _style_css(font, fill, alignment, THIN_BORDER)
+    for name, (font, fill, alignment) in TEMPLATE_STYLES.items()
+}
+_DEFAULT_CSS = _style_css(DEFAULT_FONT, DEFAULT_EMPTY_FILL, Alignment(), DEFAULT_BORDER)
+
+
+def _text(value):
+    return escape(str(value)) if value is not None else ''
+
+
+class CompiledPreview:
+    """Pre-rendered HTML of the instruction template.
+
+    The table is split around every slot cell of the render plan; the pixel
+    offset and box of each image range come from its image slots, so
+    ``render`` only formats the part's values and images.
+    """
+
+    def __init__(self, manager):
+        self.manager = manager
+        plan = get_render_plan()
+        self.width = round(sum(plan.column_pixels))
+        self.height = round(sum(plan.row_pixels))
+
+        cell_css = {
+            (row, col): _STYLE_CSS[style]
+            for row, runs in plan.style_runs.items()
+            for first_col, last_col, style in runs
+            for col in range(first_col, last_col + 1)
+        }
+
+        # Cut the table around the variable cells, in document order
+        self.fragments = []
+        self.slots = []
+        html = ['<div style="position:relative;font-family:Calibri,Arial,sans-serif;font-size:11pt">'
+                '<table style="border-collapse:collapse;table-layout:fixed;'
+                f'width:{self.width}px">']
+        html.append('<colgroup>' + ''.join(f'<col style="width:{width:.0f}px">' for width in plan.column_pixels)
+                    + '</colgroup>')
+        for row, height in enumerate(plan.row_pixels, 1):
+            html.append(f'<tr style="height:{height:.0f}px">')
+            for col in range(1, plan.max_column + 1):
+                if (row, col) in plan.covered:
+                    continue
+                coordinate = f'{get_column_letter(col)}{row}'
+                colspan, rowspan = plan.spans.get((row, col), (1, 1))
+                attributes = ''.join([
+                    f' colspan="{colspan}"' if colspan > 1 else '',
+                    f' rowspan="{rowspan}"' if rowspan > 1 else '',
+                ])
+                html.append(f'<td{attributes} style="padding:0 2px;white-space:pre-wrap;overflow:hidden;'
+                            f'{cell_css.get((row, col), _DEFAULT_CSS)}">')
+                if coordinate in plan.slot_cells:
+                    self.fragments.append(''.join(html))
+                    self.slots.append((coordinate, _text(plan.values.get(coordinate))))
+                    html = []
+                else:
+                    html.append(_text(plan.values.get(coordinate)))
+                html.append('</td>')
+            html.append('</tr>')
+        html.append('</table>')
+        self.tail = ''.join(html)
+
+        # Pixel offset and box of every image range
+        self.image_slots = {
+            category: (slot.left, slot.top, slot.box) for category, slot in plan.image_slots.items()
+        }
+
+    def _image_html(self, images_data):
+        pieces = []
+        for category, (left, top, (box_width, box_height)) in self.image_slots.items():
+            pil_image = (images_data or {}).get(category)
+            if not pil_image:
+                continue
+            encoded = encode_for_box(pil_image, box_width, box_height, 1.0, self.manager.image_quality)
+            source = base64.b64encode(encoded.data).decode('ascii')
+            pieces.append(
+                f'<img alt="{escape(category)}" src="data:image/{encoded.format};base64,{source}" '
+                f'style="position:absolute;left:{left:.0f}px;top:{top:.0f}px;'
+                f'width:{encoded.width}px;height:{encoded.height}px">'
+            )
+        return ''.join(pieces)
+
+    def render(self, data_dict, images_data=None):
+        """HTML preview of the instruction of one part"""
+        with stage('preview'):
+            cell_values = self.manager.variable_cell_values(data_dict)
+            pieces = []
+            for fragment, (coordinate, empty_text) in zip(self.fragments, self.slots):
+                pieces.append(fragment)
+                pieces.append(_text(cell_values[coordinate]) if coordinate in cell_values else empty_text)
+            pieces.append(self.tail)
+            pieces.append(self._image_html(images_data))
+            pieces.append('</div>')
+            return ''.join(pieces)
@@ -0,0 +1,1537 @@
+import pandas as pd
+import openpyxl
+from openpyxl import load_workbook, Workbook
+from openpyxl.styles import NamedStyle
+from openpyxl.drawing.image import Image
+import bisect
+import io
+import logging
+import pickle
+import re
+import threading
+import zipfile
+from collections import OrderedDict, namedtuple
+from itertools import islice
+from datetime import datetime, timezone
+
+from image_pipeline import DEFAULT_DPI_SCALE, DEFAULT_JPEG_QUALITY, encode_for_box, open_image
+from instrumentation import stage
+from layout import TEMPLATE_STYLES, TEMPLATE_VERSION, THIN_BORDER, get_render_plan, range_box
+from validation import (COUNT_UNITS, DERIVATION_FIELDS, FIELD_UNITS, ISSUE_COLUMNS, LENGTH_UNITS, derive_fields,
+                        same_unit, validate_parts)
+from xlsx_media import read_sheet_images
+
+logger = logging.getLogger(__name__)
+
+# Key under which batch records remember the sheet row they came from
+SOURCE_ROW_KEY = '_source_row'
+
+# Key under which batch records keep the header units their values could not be converted from
+HEADER_UNITS_KEY = '_header_units'
+
+# Records whose procedure steps are rendered together when a batch is streamed
+BATCH_CHUNK_SIZE = 256
+
+# Records checked together when a stream of records is validated
+VALIDATION_CHUNK_SIZE = 4096
+
+# Serialized template skeletons, keyed by template version
+_compiled_templates = {}
+
+
+def add_template_styles(wb):
+    """Register the named template styles with a workbook"""
+    for name, (font, fill, alignment) in TEMPLATE_STYLES.items():
+        wb.add_named_style(NamedStyle(name, font=font, fill=fill, border=THIN_BORDER, alignment=alignment))
+
+
+# Procedure placeholders and the part fields that fill them, first match wins
+PLACEHOLDER_FIELDS = {
+    # ONLY Inner dimensions (no Primary/Secondary references in procedures)
+    'Inner L': ('Inner L',),
+    'Inner W': ('Inner W',),
+    'Inner H': ('Inner H',),
+    'Inner Qty/Pack': ('Inner Qty/Pack',),
+    # Generic quantities (for backwards compatibility)
+    'Qty/Pack': ('Inner Qty/Pack', 'Qty/Pack'),
+    # Other parameters
+    'Qty/Veh': ('Qty/Veh',),
+    'Layer': ('Layer',),
+    'Level': ('Level',),
+}
+
+_PLACEHOLDER_RE = re.compile(r'\{([^{}]+)\}')
+
+# A placeholder segment of a compiled procedure step
+_Placeholder = namedtuple('_Placeholder', ['name'])
+
+
+def _compile_step(procedure):
+    """Split a procedure step into literal text and known placeholders"""
+    segments = []
+    position = 0
+    for match in _PLACEHOLDER_RE.finditer(procedure):
+        if match.group(1) not in PLACEHOLDER_FIELDS:
+            continue
+        if match.start() > position:
+            segments.append(procedure[position:match.start()])
+        segments.append(_Placeholder(match.group(1)))
+        position = match.end()
+    if position < len(procedure) or not segments:
+        segments.append(procedure[position:])
+    return tuple(segments)
+
+
+# Header tokens: runs of letters and digits, so case, spacing and punctuation don't matter
+_HEADER_TOKEN_RE = re.compile(r'[a-z0-9]+')
+
+# Unit tokens a header may end with, as in "Inner L-mm" or "Unit Weight (kg)"
+_UNIT_TOKENS = frozenset(['mm', 'cm', 'm', 'kg', 'kgs', 'g', 'gm', 'gms', 'nos', 'pcs'])
+
+# Procedure step columns: "Procedure Step 3", "Step 3", "Step3" or a bare "3"
+_STEP_HEADER_RE = re.compile(r'^(?:procedure )?(?:step ?)?(\d+)$')
+
+# Distinct header signatures whose column resolution is kept
+_HEADER_CACHE_SIZE = 64
+
+# Distinct single parts whose derived fields are kept, so a rerun reuses them
+_DERIVED_CACHE_SIZE = 64
+
+# Bounds of the search for the image category headers at the top of a sheet
+IMAGE_HEADER_ROWS = 10
+IMAGE_HEADER_COLUMNS = 512
+
+
+def normalize_header(header):
+    """Lower-case tokens of a column header, joined by single spaces"""
+    return ' '.join(_HEADER_TOKEN_RE.findall(str(header).lower()))
+
+
+def _split_unit(normalized):
+    """A normalized header without its unit suffix, and that unit, None if it has none"""
+    stem, _, unit = normalized.rpartition(' ')
+    if stem and unit in _UNIT_TOKENS:
+        return stem, unit
+    return normalized, None
+
+
+def _number_text(number):
+    """Text of a number with at most three decimals"""
+    return f'{number:.3f}'.rstrip('0').rstrip('.')
+
+
+def _converted(text, factor):
+    """Text of a cell times ``factor`` if it is a bare number, else as it is"""
+    if text is None or factor is None:
+        return text
+    try:
+        number = float(text)
+    except ValueError:
+        return text
+    return _number_text(number * factor)
+
+
+def _trim_row(row):
+    """Row values without the trailing empty cells"""
+    end = len(row)
+    while end and row[end - 1] is None:
+        end -= 1
+    return tuple(row[:end])
+
+
+def _sheet_column_names(header):
+    """Column names pandas gives a header row: 'Unnamed: i' for blanks, '.n' suffixes for repeats"""
+    names = []
+    seen = set()
+    counts = {}
+    for index, value in enumerate(header):
+        name = f'Unnamed: {index}' if value is None else value
+        if name in seen:
+            count = counts.get(name, 0)
+            candidate = name
+            while candidate in seen:
+                count += 1
+                candidate = f'{name}.{count}'
+            counts[name] = count
+            name = candidate
+        seen.add(name)
+        names.append(name)
+    return names
+
+
+def _cell_text(value):
+    """Text of one cell as a part record holds it, None for an empty cell"""
+    if value is None or value == '':
+        return None
+    # pandas reads whole-number floats as integers too
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value)
+
+
+def _part_frame(parts):
+    """A DataFrame of part records, one row per part, or ``parts`` if it already is one"""
+    if isinstance(parts, pd.DataFrame):
+        return parts
+    records = list(parts)
+    return pd.DataFrame(records, index=pd.RangeIndex(len(records)))
+
+
+def _derived_values(frame):
+    """Per part, the fields derived for it by ``derive_fields``"""
+    derived = derive_fields(frame)
+    if derived.columns.empty:
+        return [{} for _ in range(len(frame))]
+    return [
+        {field: value for field, value in values.items() if isinstance(value, str)}
+        for values in derived.to_dict('records')
+    ]
+
+
+def _column_as_text(values):
+    """Convert a column to the same text ``str()`` gives per cell, keeping nulls"""
+    return values.map(str, na_action='ignore')
+
+
+def _column_converted(values, factor):
+    """``_converted`` over a text column"""
+    if factor is None:
+        return values
+    numbers = pd.to_numeric(values, errors='coerce')
+    found = numbers.notna()
+    return values.mask(found, (numbers[found] * factor).map(_number_text))
+
+
+class ExactPackagingTemplateManager:
+    def __init__(self):
+        self.template_fields = {
+            # Header Information
+            'Revision No.': '',
+            'Date': '',
+            
+            # Vendor Information
+            'Vendor Code': '',
+            'Vendor Name': '',
+            'Vendor Location': '',
+            
+            # Part Information
+            'Part No.': '',
+            'Part Description': '',
+            'Part Unit Weight': '',
+            'Part Weight Unit': '',
+            'Part L': '',
+            'Part W': '',
+            'Part H': '',
+            
+            # Inner Packaging (distinct from Primary)
+            'Inner Packaging Type': '',
+            'Inner L': '',
+            'Inner W': '',
+            'Inner H': '',
+            'Inner Qty/Pack': '',
+            'Inner Empty Weight': '',
+            'Inner Pack Weight': '',
+            
+            # Primary Packaging
+            'Primary Packaging Type': '',
+            'Primary L-mm': '',
+            'Primary W-mm': '',
+            'Primary H-mm': '',
+            'Primary Qty/Pack': '',
+            'Primary Empty Weight': '',
+            'Primary Pack Weight': '',
+            
+            # Secondary Packaging
+            'Secondary Packaging Type': '',
+            'Secondary L-mm': '',
+            'Secondary W-mm': '',
+            'Secondary H-mm': '',
+            'Secondary Qty/Pack': '',
+            'Secondary Empty Weight': '',
+            'Secondary Pack Weight': '',
+            
+            # Packaging Procedures (10 steps)
+            'Procedure Step 1': '',
+            'Procedure Step 2': '',
+            'Procedure Step 3': '',
+            'Procedure Step 4': '',
+            'Procedure Step 5': '',
+            'Procedure Step 6': '',
+            'Procedure Step 7': '',
+            'Procedure Step 8': '',
+            'Procedure Step 9': '',
+            'Procedure Step 10': '',
+            'Procedure Step 11': '',
+            
+            # Approval
+            'Issued By': '',
+            'Reviewed By': '',
+            'Approved By': '',
+            
+            # Additional fields
+            'Problem If Any': '',
+            'Caution': ''
+        }
+        
+        # Predefined packaging procedures for different types
+        self.packaging_procedures = {
+            "BOX IN BOX SENSITIVE": [
+                "Pick up 1 quantity of part and apply bubble wrapping over it",
+                "Apply tape and Put 1 such bubble wrapped part into a carton box [L-{Inner L} mm, W-{Inner W} mm, H-{Inner H} mm]",
+                "Seal carton box and put {Inner Qty/Pack} such carton boxes into another carton box [L-{Inner L} mm, W-{Inner W} mm, H-{Inner H} mm]",
+                "Seal carton box and put Traceability label as per PMSPL standard guideline",
+                "Prepare additional carton boxes in line with procurement schedule (multiple of pack quantity -- {Inner Qty/Pack})",
+                "If procurement schedule is for less no. of boxes, then load similar boxes of other parts on same wooden pallet.",
+                "Load carton boxes on base wooden pallet -- {Layer} boxes per layer & max {Level} level (max height including pallet -1000 mm)",
+                "Put corner / edge protector and apply pet strap (2 times -- cross way)",
+                "Apply traceability label on complete pack",
+                "Attach packing list along with dispatch document and tag copy of same on pack (in case of multiple parts on same pallet)",
+                "Ensure Loading/Unloading of palletize load using Hand pallet / stacker / forklift only."
+            ],
+            
+            "BOX IN BOX": [
+                "Pick up 1 quantity of part and put it in a polybag",
+                "seal the polybag and put it into a carton box [L-{Inner L} mm, W-{Inner W} mm, H-{Inner H} mm]",
+                "Put {Inner Qty/Pack} such carton boxes into another carton box [L-{Inner L} mm, W-{Inner W} mm, H-{Inner H} mm]",
+                "Seal carton box and put Traceability label as per PMSPL standard guideline",
+                "Prepare additional carton boxes in line with procurement schedule (multiple of pack quantity -- {Inner Qty/Pack})",
+                "If procurement schedule is for less no. of boxes, then load similar boxes of other parts on same wooden pallet.",
+                "Load carton boxes on base wooden pallet -- {Layer} boxes per layer & max {Level} level (max height including pallet -1000 mm)",
+                "Put corner / edge protector and apply pet strap (2 times -- cross way)",
+                "Apply traceability label on complete pack",
+                "Attach packing list along with dispatch document and tag copy of same on pack (in case of multiple parts on same pallet)",
+                "Ensure Loading/Unloading of palletize load using Hand pallet / stacker / forklift only."
+            ],
+            
+            "CARTON BOX WITH SEPARATOR FOR ONE PART": [
+                "Pick up {Qty/Veh} parts and apply bubble wrapping over it (individually)",
+                "Apply tape and Put bubble wrapped part into a carton box. Apply part separator & filler material between two parts to arrest part movement during handling",
+                "Seal carton box and put Traceability label as per PMSPL standard guideline",
+                "Prepare additional carton boxes in line with procurement schedule (multiple of pack quantity -- {Inner Qty/Pack})",
+                "Load carton boxes on base wooden pallet -- {Layer} boxes per layer & max {Level} level",
+                "If procurement schedule is for less no. of boxes, then load similar boxes of other parts on same wooden pallet.",
+                "Put corner / edge protector and apply pet strap (2 times -- cross way)",
+                "Apply traceability label on complete pack",
+                "Attach packing list along with dispatch document and tag copy of same on pack (in case of multiple parts on same pallet)",
+                "Ensure Loading/Unloading of palletize load using Hand pallet / stacker / forklift only.",
+                ""
+            ],
+            
+            "INDIVIDUAL NOT SENSITIVE": [
+                "Pick up one part and put it into a polybag",
+                "Seal polybag and Put polybag into a carton box",
+                "Seal carton box and put Traceability label as per PMSPL standard guideline",
+                "Prepare additional carton boxes in line with procurement schedule (multiple of pack quantity -- {Inner Qty/Pack})",
+                "Load carton boxes on base wooden pallet -- Maximum {Layer} boxes per layer & Maximum {Level} level (max height including pallet - 1000 mm)",
+                "If procurement schedule is for less no. of boxes, then load similar boxes of other parts on same wooden pallet.",
+                "Put corner / edge protector and apply pet strap (2 times -- cross way)",
+                "Apply traceability label on complete pack",
+                "Attach packing list along with dispatch document and tag copy of same on pack (in case of multiple parts on same pallet)",
+                "Ensure Loading/Unloading of palletize load using Hand pallet / stacker / forklift only.",
+                ""
+            ],
+            
+            "INDIVIDUAL PROTECTION FOR EACH PART": [
+                "Pick up {Qty/Veh} parts and apply bubble wrapping over it (individually)",
+                "Apply tape and Put bubble wrapped part into a carton box. Apply part separator & filler material between two parts to arrest part movement during handling",
+                "Seal carton box and put Traceability label as per PMSPL standard guideline",
+                "Prepare additional carton boxes in line with procurement schedule (multiple of pack quantity -- {Inner Qty/Pack})",
+                "Load carton boxes on base wooden pallet -- {Layer} boxes per layer & max {Level} level (max height including pallet - 1000 mm)",
+                "If procurement schedule is for less no. of boxes, then load similar boxes of other parts on same wooden pallet.",
+                "Put corner / edge protector and apply pet strap (2 times -- cross way)",
+                "Apply traceability label on complete pack",
+                "Attach packing list along with dispatch document and tag copy of same on pack (in case of multiple parts on same pallet)",
+                "Ensure Loading/Unloading of palletize load using Hand pallet / stacker / forklift only.",
+                ""
+            ],
+            
+            "INDIVIDUAL SENSITIVE": [
+                "Pick up one part and apply bubble wrapping over it",
+                "Apply tape and Put bubble wrapped part into a carton box",
+                "Seal carton box and put Traceability label as per PMSPL standard guideline",
+                "Prepare additional carton boxes in line with procurement schedule (multiple of pack quantity -- {Inner Qty/Pack})",
+                "Load carton boxes on base wooden pallet -- {Layer} boxes per layer & max {Level} level (max height including pallet - 1000 mm)",
+                "If procurement schedule is for less no. of boxes, then load similar boxes of other parts on same wooden pallet.",
+                "Put corner / edge protector and apply pet strap (2 times -- cross way)",
+                "Apply traceability label on complete pack",
+                "Attach packing list along with dispatch document and tag copy of same on pack (in case of multiple parts on same pallet)",
+                "Ensure Loading/Unloading of palletize load using Hand pallet / stacker / forklift only.",
+                ""
+            ],
+            
+            "MANY IN ONE TYPE": [
+                "Pick up {Qty/Veh} quantity of part and put it in a polybag",
+                "Seal polybag and Put it into a carton box",
+                "Seal carton box and put Traceability label as per PMSPL standard guideline",
+                "Prepare additional carton boxes in line with procurement schedule (multiple of pack quantity -- {Inner Qty/Pack})",
+                "If procurement schedule is for less no. of boxes, then load similar boxes of other parts on same wooden pallet.",
+                "Load carton boxes on base wooden pallet -- {Layer} boxes per layer & max {Level} level (max height including pallet - 1000 mm)",
+                "Put corner / edge protector and apply pet strap (2 times -- cross way)",
+                "Apply traceability label on complete pack",
+                "Attach packing list along with dispatch document and tag copy of same on pack (in case of multiple parts on same pallet)",
+                "Ensure Loading/Unloading of palletize load using Hand pallet / stacker / forklift only.",
+                ""
+            ],
+            
+            "SINGLE BOX": [
+                "Pick up 1 quantity of part and put it in a polybag",
+                "Put into a carton box",
+                "Seal carton box and put Traceability label as per PMSPL standard guideline",
+                "Prepare additional carton boxes in line with procurement schedule (multiple of pack quantity -- {Inner Qty/Pack})",
+                "If procurement schedule is for less no. of boxes, then load similar boxes of other parts on same wooden pallet.",
+                "Load carton boxes on base wooden pallet -- {Layer} boxes per layer & max {Level} level",
+                "Put corner / edge protector and apply pet strap (2 times -- cross way) and stretch wrap it",
+                "Apply traceability label on complete pack",
+                "Attach packing list along with dispatch document and tag copy of same on pack (in case of multiple parts on same pallet)",
+                "Ensure Loading/Unloading of palletize load using Hand pallet / stacker / forklift only.",
+                ""
+            ]
+        }
+
+        # Procedure steps compiled on first use, keyed by packaging type
+        self._compiled_procedures = {}
+
+        # Alias index of field_mapping, compiled on first use, and the column
+        # resolution of every header signature seen so far
+        self._header_index = None
+        self._resolved_headers = OrderedDict()
+        # Image headers found in each distinct header row seen so far
+        self._image_header_rows = OrderedDict()
+        # Derived fields of each distinct single part seen so far
+        self._derived_fields = OrderedDict()
+        # The app shares one manager between its sessions' threads
+        self._cache_lock = threading.Lock()
+
+        # Create a mapping of possible column names to our field names
+        self.field_mapping = {
+            # Basic info
+            'revision no.': 'Revision No.',
+            'revision': 'Revision No.',
+            'date': 'Date',
+            
+            # Vendor info
+            'vendor code': 'Vendor Code',
+            'code': 'Vendor Code',
+            'vendor name': 'Vendor Name',
+            'name': 'Vendor Name',
+            'vendor location': 'Vendor Location',
+            'location': 'Vendor Location',
+            
+            # Part info
+            'part no.': 'Part No.',
+            'part number': 'Part No.',
+            'part description': 'Part Description',
+            'description': 'Part Description',
+            'part unit weight': 'Part Unit Weight',
+            'unit weight': 'Part Unit Weight',
+            'weight': 'Part Unit Weight',
+            'part weight unit': 'Part Weight Unit',
+            'weight unit': 'Part Weight Unit',
+            'part l': 'Part L',
+            'length': 'Part L',
+            'part w': 'Part W',
+            'width': 'Part W',
+            'part h': 'Part H',
+            'height': 'Part H',
+
+            
+             # INNER packaging - completely separate
+            'inner l': 'Inner L',
+            'inner l-mm': 'Inner L',
+            'inner w': 'Inner W', 
+            'inner w-mm': 'Inner W',
+            'inner h': 'Inner H',
+            'inner h-mm': 'Inner H',
+            'inner qty/pack': 'Inner Qty/Pack',
+            'inner empty weight': 'Inner Empty Weight',
+            'inner pack weight': 'Inner Pack Weight',
+            
+            # PRIMARY packaging - separate from inner
+            'primary packaging type': 'Primary Packaging Type',
+            'primary l': 'Primary L',
+            'primary l-mm': 'Primary L-mm',
+            'primary w': 'Primary W-mm',
+            'primary w-mm': 'Primary W',
+            'primary h': 'Primary H-mm',
+            'primary h-mm': 'Primary H',
+            'primary qty/pack': 'Primary Qty/Pack',
+            'primary empty weight': 'Primary Empty Weight',
+            'primary pack weight': 'Primary Pack Weight',
+        
+            # Generic packaging (when not specified as primary or inner)
+            'packaging type': 'Packaging Type',
+            'qty/pack': 'Qty/Pack',
+            'empty weight': 'Empty Weight',
+            'pack weight': 'Pack Weight',
+           
+            # Secondary packaging
+            'secondary packaging type': 'Secondary Packaging Type',
+            'secondary l-mm': 'Secondary L-mm',
+            'secondary l': 'Secondary L-mm',
+            'secondary w-mm': 'Secondary W-mm',
+            'secondary w': 'Secondary W-mm',
+            'secondary h-mm': 'Secondary H-mm',
+            'secondary h': 'Secondary H-mm',
+            'secondary qty/pack': 'Secondary Qty/Pack',
+            'secondary empty weight': 'Secondary Empty Weight',
+            'secondary pack weight': 'Secondary Pack Weight',
+            
+            # Additional procedure parameters
+            'qty/veh': 'Qty/Veh',
+            'qty per vehicle': 'Qty/Veh',
+            'layer': 'Layer',
+            'layers': 'Layer',
+            'level': 'Level',
+            'levels': 'Level',
+            
+            # Approval
+            'issued by': 'Issued By',
+            'reviewed by': 'Reviewed By',
+            'approved by': 'Approved By',
+            
+            # Additional
+            'problem if any': 'Problem If Any',
+            'caution': 'Caution'
+        }
+
+        # Cells that receive the part's data in the generated template
+        plan = get_render_plan()
+        self.cell_mapping = dict(plan.field_slots)
+
+        # Embedded pictures are stored at dpi_scale times their display size
+        self.image_dpi_scale = DEFAULT_DPI_SCALE
+        self.image_quality = DEFAULT_JPEG_QUALITY
+
+        # Procedure steps fill rows 23-33 of column B
+        self.procedure_cells = dict(plan.procedure_slots)
+
+        # Cell ranges that receive the reference images, in placement order
+        self.image_slots = plan.image_slots
+        self.image_ranges = {
+            category: tuple(slot.cell_range.split(':')) for category, slot in plan.image_slots.items()
+        }
+        # Image category of each of those ranges, by (start cell, end cell)
+        self.image_categories = {cells: category for category, cells in self.image_ranges.items()}
+    
+    def compiled_procedure(self, packaging_type):
+        """Procedure steps of a packaging type, pre-split into text and placeholders"""
+        compiled = self._compiled_procedures.get(packaging_type)
+        if compiled is None:
+            procedures = self.packaging_procedures.get(packaging_type, [""] * 11)
+            compiled = [_compile_step(procedure) for procedure in procedures]
+            self._compiled_procedures[packaging_type] = compiled
+        return compiled
+
+    def get_procedure_steps(self, packaging_type, data_dict=None):
+        """Get predefined procedure steps for selected packaging type with placeholders filled"""
+        if not data_dict:
+            return self.packaging_procedures.get(packaging_type, [""] * 11)
+
+        values = {}
+        for placeholder, keys in PLACEHOLDER_FIELDS.items():
+            key = next((key for key in keys if key in data_dict), None)
+            values[placeholder] = str(data_dict[key]) if key is not None else 'XXX'
+        return [
+            ''.join(values[segment.name] if isinstance(segment, _Placeholder) else segment
+                    for segment in segments)
+            for segments in self.compiled_procedure(packaging_type)
+        ]
+
+    def render_procedure_column(self, packaging_type, parts):
+        """Fill the steps of one packaging type for a whole column of parts at once.
+
+        ``parts`` is a DataFrame with one row per part (or a list of part
+        records). Every placeholder is resolved as a column and each step is
+        built by column-wise string concatenation; the result holds the
+        filled steps of every part, in order, as ``get_procedure_steps``
+        would return them.
+        """
+        frame = _part_frame(parts)
+        missing = pd.Series('XXX', index=frame.index, dtype=object)
+        values = {}
+        for placeholder, keys in PLACEHOLDER_FIELDS.items():
+            column = missing
+            for key in reversed(keys):
+                if key in frame:
+                    column = _column_as_text(frame[key]).fillna(column)
+            values[placeholder] = column
+
+        steps = []
+        for segments in self.compiled_procedure(packaging_type):
+            if not any(isinstance(segment, _Placeholder) for segment in segments):
+                steps.append([''.join(segments)] * len(frame))
+                continue
+            step = pd.Series('', index=frame.index, dtype=object)
+            for segment in segments:
+                step = step + (values[segment.name] if isinstance(segment, _Placeholder) else segment)
+            steps.append(step.tolist())
+        return [list(part_steps) for part_steps in zip(*steps)] if steps else [[] for _ in range(len(frame))]
+
+    def derived_fields(self, data_dict):
+        """Fields ``derive_fields`` fills in for one part, kept by the values they are derived from"""
+        signature = tuple(str(data_dict.get(key)) for key in DERIVATION_FIELDS)
+        with self._cache_lock:
+            derived = self._derived_fields.get(signature)
+            if derived is not None:
+                self._derived_fields.move_to_end(signature)
+        if derived is None:
+            derived = _derived_values(_part_frame([data_dict]))[0]
+            self._cache(self._derived_fields, signature, derived, _DERIVED_CACHE_SIZE)
+        return dict(derived)
+
+    def procedure_fields(self, packaging_type):
+        """Placeholders used by the steps of a packaging type and the part fields that fill them"""
+        used = {
+            segment.name
+            for segments in self.compiled_procedure(packaging_type)
+            for segment in segments if isinstance(segment, _Placeholder)
+        }
+        return {placeholder: keys for placeholder, keys in PLACEHOLDER_FIELDS.items() if placeholder in used}
+
+    def validate_records(self, records, procedure_type=None):
+        """Check a batch of part records with ``validate_parts``.
+
+        The fields the selected procedure needs are required, issues are
+        numbered by the sheet row each part came from, and header units the
+        values could not be converted from are reported too.
+        """
+        frame = _part_frame(records)
+        required = self.procedure_fields(procedure_type) if procedure_type in self.packaging_procedures else None
+        positions = pd.Series(range(1, len(frame) + 1), index=frame.index)
+        rows = frame[SOURCE_ROW_KEY].fillna(positions).astype(int) if SOURCE_ROW_KEY in frame else positions
+        header_units = frame[HEADER_UNITS_KEY].dropna() if HEADER_UNITS_KEY in frame else ()
+        return validate_parts(frame, required, rows, header_units.iloc[0] if len(header_units) else None)
+
+    def validate_record_stream(self, records, procedure_type=None, chunksize=VALIDATION_CHUNK_SIZE):
+        """The issue table of ``validate_records`` over a stream of records, ``chunksize`` records at a time"""
+        records = iter(records)
+        issues = []
+        while True:
+            chunk = list(islice(records, chunksize))
+            if not chunk:
+                break
+            found = self.validate_records(chunk, procedure_type).issues
+            if not found.empty:
+                issues.append(found)
+        if not issues:
+            return pd.DataFrame(columns=ISSUE_COLUMNS)
+        # Every chunk reports the header units again
+        return pd.concat(issues, ignore_index=True).drop_duplicates(ignore_index=True)
+            
+    def header_index(self):
+        """Compiled ``field_mapping``: (normalized alias -> field,
+        same without unit suffix -> (field, unit the alias names))"""
+        if self._header_index is None:
+            exact, unitless = {}, {}
+            for alias, field in self.field_mapping.items():
+                key = normalize_header(alias)
+                exact.setdefault(key, field)
+                stem, unit = _split_unit(key)
+                # An alias naming its unit also matches with another unit after it, as in "Inner L-mm (cm)"
+                unitless.setdefault(key, (field, unit))
+                unitless.setdefault(stem, (field, unit))
+            self._header_index = (exact, unitless)
+        return self._header_index
+
+    def resolve_columns(self, columns):
+        """Map sheet column headers to template fields and procedure steps.
+
+        Headers are compared on their normalized tokens, an exact alias
+        first and the header without its unit suffix otherwise. The result
+        is cached per header signature, so sheets of a known layout skip the
+        resolution entirely.
+        """
+        field_columns, step_columns, _ = self._resolved(columns)
+        return {field: list(cols) for field, cols in field_columns.items()}, dict(step_columns)
+
+    def header_units(self, columns):
+        """Conversion factor of every column whose header names another unit than its field's,
+        and ``{field: unit}`` of the header units that cannot be converted.
+
+        "Inner L (mm)" needs nothing; the bare numbers of "Primary L (cm)"
+        are converted to millimetres; "Part Unit Weight (g)" keeps its
+        values as they are and validation reports its unit.
+        """
+        factors, unconverted = self._resolved(columns)[2]
+        return dict(factors), dict(unconverted)
+
+    def _resolved(self, columns):
+        signature = tuple((type(col).__name__, str(col)) for col in columns)
+        with self._cache_lock:
+            resolved = self._resolved_headers.get(signature)
+            if resolved is not None:
+                self._resolved_headers.move_to_end(signature)
+        if resolved is None:
+            resolved = self._resolve_columns(columns)
+            self._cache(self._resolved_headers, signature, resolved, _HEADER_CACHE_SIZE)
+        return resolved
+
+    def _cache(self, cache, key, value, size):
+        """Keep ``value`` in one of the manager's LRUs, dropping the oldest beyond ``size``"""
+        with self._cache_lock:
+            cache[key] = value
+            if len(cache) > size:
+                cache.popitem(last=False)
+
+    def _resolve_columns(self, columns):
+        exact, unitless = self.header_index()
+        field_columns = {}
+        step_numbers = {}
+        factors, unconverted = {}, {}
+        for col in columns:
+            header = normalize_header(col)
+            field = exact.get(header)
+            if not field:
+                stem, unit = _split_unit(header)
+                field, field_unit = unitless.get(stem, (None, None))
+                # Counts need no conversion; lengths are converted to the field's unit
+                target = field_unit or FIELD_UNITS.get(field)
+                if field and unit and unit not in COUNT_UNITS and not same_unit(unit, target):
+                    if unit in LENGTH_UNITS and target in LENGTH_UNITS:
+                        factors[col] = LENGTH_UNITS[unit] / LENGTH_UNITS[target]
+                    else:
+                        unconverted.setdefault(field, unit)
+            if field:
+                field_columns.setdefault(field, []).append(col)
+
+            # Procedure steps: first column naming the step number
+            match = _STEP_HEADER_RE.match(header)
+            if match and 1 <= int(match.group(1)) <= len(self.procedure_cells):
+                step_numbers.setdefault(int(match.group(1)), col)
+        step_columns = {f'Procedure Step {number}': col for number, col in sorted(step_numbers.items())}
+        return field_columns, step_columns, (factors, unconverted)
+
+    def extract_data_from_dataframe(self, df):
+        """Extract the first non-empty value of every mapped column of a sheet"""
+        extracted_data = {}
+        field_columns, step_columns = self.resolve_columns(df.columns)
+        factors, _ = self.header_units(df.columns)
+        column_fields = {col: field for field, cols in field_columns.items() for col in cols}
+        
+        # Extract data from DataFrame
+        for col in df.columns:
+            if col in column_fields:
+                field_name = column_fields[col]
+                # Get first non-null value from the column
+                values = df[col].dropna()
+                if len(values) > 0:
+                    extracted_data[field_name] = _converted(str(values.iloc[0]), factors.get(col))
+                    
+        logger.debug("extracted packaging fields: %s", {
+            key: value for key, value in extracted_data.items()
+            if any(x in key.lower() for x in ['inner', 'primary', 'secondary', 'qty'])
+        })
+        
+        # Try to extract procedure steps if they exist
+        for step_field, col in step_columns.items():
+            values = df[col].dropna()
+            if len(values) > 0:
+                extracted_data[step_field] = str(values.iloc[0])
+        return extracted_data
+
+    def extract_data_from_excel(self, uploaded_file):
+        """Extract data from uploaded Excel file"""
+        try:
+            # Read the Excel file
+            with stage('parse'):
+                df = pd.read_excel(uploaded_file, sheet_name=0)
+                extracted_data = self.extract_data_from_dataframe(df)
+            logger.info("Successfully extracted %d fields from Excel file", len(extracted_data))
+            return extracted_data
+            
+        except Exception as e:
+            logger.error("Error reading Excel file: %s", e)
+            return {}
+
+    def ingest_excel(self, uploaded_file, streaming=False):
+        """Read an upload once and extract its data, its images and the images of each part row.
+
+        With ``streaming`` the values come from ``extract_data_from_sheet``, so a very large sheet is never loaded.
+        """
+        buffer = io.BytesIO(uploaded_file.getvalue())
+        if not zipfile.is_zipfile(buffer):
+            try:
+                with stage('parse'):
+                    extracted_data = self.extract_data_from_dataframe(pd.read_excel(buffer, sheet_name=0))
+            except Exception as e:
+                logger.error("Error reading Excel file: %s", e)
+                return {}, self.empty_images_data(), {}
+            logger.info("Successfully extracted %d fields from Excel file", len(extracted_data))
+            return extracted_data, self.empty_images_data(), {}
+        try:
+            with stage('parse'):
+                wb = load_workbook(buffer, read_only=True, data_only=True)
+                image_headers = self.scan_image_headers(wb.active)
+                if streaming:
+                    extracted_data = self.extract_data_from_sheet(wb.active)
+                    wb.close()
+                else:
+                    # pandas closes the workbook once it has read it
+                    df = pd.read_excel(wb, sheet_name=0, engine='openpyxl')
+                    extracted_data = self.extract_data_from_dataframe(df)
+        except Exception as e:
+            logger.error("Error reading Excel file: %s", e)
+            return {}, self.empty_images_data(), {}
+
+        logger.info("Successfully extracted %d fields from Excel file", len(extracted_data))
+        with stage('image extraction'), zipfile.ZipFile(buffer) as archive:
+            images_data, row_images = self.sheet_images_from_archive(archive, image_headers)
+        return extracted_data, images_data, row_images
+
+    def records_from_dataframe(self, df):
+        """Map every row of a master parts sheet to its own record in one pass.
+
+        Columns are resolved once through ``field_mapping``; each resolved
+        column is converted to text as a whole, and when several columns map
+        to the same field the right-most non-empty value wins, exactly as
+        ``extract_data_from_excel`` does for a single part. The sheet row of
+        each part is kept under ``SOURCE_ROW_KEY``, and the header units
+        that could not be converted under ``HEADER_UNITS_KEY``.
+        """
+        field_columns, step_columns = self.resolve_columns(df.columns)
+        factors, unconverted = self.header_units(df.columns)
+        for step_field, col in step_columns.items():
+            field_columns.setdefault(step_field, []).append(col)
+
+        fields = {}
+        for field, cols in field_columns.items():
+            merged = None
+            for col in cols:
+                values = _column_converted(_column_as_text(df[col]), factors.get(col))
+                merged = values if merged is None else values.combine_first(merged)
+            fields[field] = merged
+
+        if not fields:
+            return []
+
+        frame = pd.DataFrame(fields, index=df.index)
+        keep = frame.notna().any(axis=1)
+        frame = frame[keep]
+        # pandas puts the header on sheet row 1, so data starts at row 2
+        source_rows = (pd.RangeIndex(len(df))[keep.to_numpy()] + 2).tolist()
+
+        records = []
+        for source_row, row in zip(source_rows, frame.to_dict('records')):
+            record = {key: value for key, value in row.items() if isinstance(value, str)}
+            record[SOURCE_ROW_KEY] = source_row
+            if unconverted:
+                record[HEADER_UNITS_KEY] = unconverted
+            records.append(record)
+        return records
+
+    def extract_records_from_excel(self, uploaded_file):
+        """Extract one record per part row from a master parts spreadsheet"""
+        try:
+            with stage('parse'):
+                df = pd.read_excel(uploaded_file, sheet_name=0)
+                records = self.records_from_dataframe(df)
+            logger.info("Successfully extracted %d part records from Excel file", len(records))
+            return records
+        except Exception as e:
+            logger.error("Error reading Excel file: %s", e)
+            return []
+    
+    def sheet_rows(self, ws):
+        """Column names of a read-only sheet's header row and an iterator of its (sheet row, values) after it"""
+        # Sheet rows are numbered from 1; leading blank rows come before the header
+        rows = enumerate(ws.iter_rows(values_only=True), 1)
+        header = next((row for _, row in rows if any(value is not None for value in row)), None)
+        if header is None:
+            return [], iter(())
+        return _sheet_column_names(header), rows
+
+    def extract_data_from_sheet(self, ws):
+        """extract_data_from_dataframe on a read-only sheet, reading rows only
+        until every mapped column has shown a value"""
+        columns, rows = self.sheet_rows(ws)
+        field_columns, step_columns = self.resolve_columns(columns)
+        position = {col: index for index, col in enumerate(columns)}
+        index_factors = {position[col]: factor for col, factor in self.header_units(columns)[0].items()}
+        column_fields = {position[col]: field for field, cols in field_columns.items() for col in cols}
+        step_fields = {position[col]: step_field for step_field, col in step_columns.items()}
+
+        first_values = {}
+        pending = set(column_fields) | set(step_fields)
+        for _, row in rows:
+            if not pending:
+                break
+            for index in [index for index in pending if index < len(row)]:
+                value = _cell_text(row[index])
+                if value is not None:
+                    first_values[index] = _converted(value, index_factors.get(index))
+                    pending.discard(index)
+
+        # Right-most column wins, then the procedure steps, as in extract_data_from_dataframe
+        extracted_data = {}
+        for index in sorted(column_fields):
+            if index in first_values:
+                extracted_data[column_fields[index]] = first_values[index]
+        for index, step_field in step_fields.items():
+            if index in first_values:
+                extracted_data[step_field] = first_values[index]
+        return extracted_data
+
+    def iter_records_from_excel(self, source):
+        """Stream one record per part row of a master parts spreadsheet.
+
+        ``source`` is a path or a binary file. An xlsx sheet is read row by
+        row by openpyxl in read-only mode and only the columns that resolve
+        through ``field_mapping`` are kept, so memory stays flat whatever
+        the size of the sheet; other formats fall back to
+        ``extract_records_from_excel``. The records are those of
+        ``records_from_dataframe`` except that each cell is converted on its
+        own: a whole number reads '12' where pandas may give '12.0' to a
+        column with gaps, and text such as 'N/A' is kept as written.
+        """
+        if not zipfile.is_zipfile(source):
+            yield from self.extract_records_from_excel(source)
+            return
+        if hasattr(source, 'seek'):
+            source.seek(0)
+        try:
+            wb = load_workbook(source, read_only=True, data_only=True)
+        except Exception as e:
+            logger.error("Error reading Excel file: %s", e)
+            return
+
+        count = 0
+        try:
+            columns, rows = self.sheet_rows(wb.active)
+            field_columns, step_columns = self.resolve_columns(columns)
+            for step_field, col in step_columns.items():
+                field_columns.setdefault(step_field, []).append(col)
+            position = {col: index for index, col in enumerate(columns)}
+            factors, unconverted = self.header_units(columns)
+            index_factors = {position[col]: factor for col, factor in factors.items()}
+            # Right-most non-empty column first, as records_from_dataframe merges them
+            projection = [
+                (field, [position[col] for col in reversed(cols)]) for field, cols in field_columns.items()
+            ]
+            if not projection:
+                return
+
+            for source_row, row in rows:
+                record = {}
+                for field, indexes in projection:
+                    for index in indexes:
+                        value = _cell_text(row[index]) if index < len(row) else None
+                        if value is not None:
+                            record[field] = _converted(value, index_factors.get(index))
+                            break
+                if record:
+                    record[SOURCE_ROW_KEY] = source_row
+                    if unconverted:
+                        record[HEADER_UNITS_KEY] = unconverted
+                    count += 1
+                    yield record
+        except Exception as e:
+            logger.error("Error reading Excel file: %s", e)
+            return
+        finally:
+            wb.close()
+        logger.info("Successfully extracted %d part records from Excel file", count)
+
+    def empty_images_data(self):
+        """Image slots of a template, none of them filled yet"""
+        return {
+            'Current Packaging': None,
+            'Primary Packaging': None,
+            'Secondary Packaging': None,
+            'Label': None
+        }
+
+    def extract_images_from_excel(self, uploaded_file):
+        """Extract images from Excel file based on column headers and row positions"""
+        try:
+            with stage('image extraction'):
+                buffer = io.BytesIO(uploaded_file.getvalue())
+                if not zipfile.is_zipfile(buffer):
+                    logger.debug("No images in a legacy .xls upload")
+                    return self.empty_images_data()
+                wb = load_workbook(buffer, read_only=True, data_only=True)
+                image_headers = self.scan_image_headers(wb.active)
+                wb.close()
+                with zipfile.ZipFile(buffer) as archive:
+                    return self.extract_images_from_archive(archive, image_headers)
+        except Exception as e:
+            logger.error("Could not extract images: %s", e)
+            return self.empty_images_data()
+
+    def extract_images_from_archive(self, archive, image_headers):
+        """Assign the pictures of an xlsx zip to categories by header column.
+
+        ``image_headers`` are the category header positions and header row
+        found by ``scan_image_headers``; the pictures and their anchors come
+        straight from the drawing parts of ``archive``, and an image is only
+        decoded once it has been assigned to a category.
+        """
+        images_data = self.empty_images_data()
+        try:
+            header_positions, header_row = image_headers
+            if not header_positions:
+                logger.warning("Could not find column headers in the Excel file")
+                return images_data
+            return self.decode_images(self.assign_images(read_sheet_images(archive), header_positions, header_row))
+        except Exception as e:
+            logger.error("Could not extract images: %s", e)
+            return images_data
+
+    def sheet_images_from_archive(self, archive, image_headers):
+        """The category images and the images of each part row of an xlsx zip.
+
+        Like ``extract_images_from_archive``, but the drawing parts are read
+        once and the same pictures are assigned both by header column and
+        by catalogue row, so ingesting an upload does not re-parse them.
+        Both hold the raw picture bytes, see ``decode_images``.
+        """
+        header_positions, header_row = image_headers
+        if not header_positions:
+            logger.warning("Could not find column headers in the Excel file")
+            return self.empty_images_data(), {}
+        try:
+            sheet_images = read_sheet_images(archive)
+            return (self.assign_images(sheet_images, header_positions, header_row),
+                    self.assign_row_images(sheet_images, header_positions, header_row))
+        except Exception as e:
+            logger.error("Could not extract images: %s", e)
+            return self.empty_images_data(), {}
+
+    def extract_sheet_images_from_excel(self, uploaded_file):
+        """``sheet_images_from_archive`` of an upload: its images and those of each part row, as raw bytes"""
+        try:
+            with stage('image extraction'):
+                buffer = io.BytesIO(uploaded_file.getvalue())
+                if not zipfile.is_zipfile(buffer):
+                    logger.debug("No images in a legacy .xls upload")
+                    return self.empty_images_data(), {}
+                wb = load_workbook(buffer, read_only=True, data_only=True)
+                image_headers = self.scan_image_headers(wb.active)
+                wb.close()
+                with zipfile.ZipFile(buffer) as archive:
+                    return self.sheet_images_from_archive(archive, image_headers)
+        except Exception as e:
+            logger.error("Could not extract images: %s", e)
+            return self.empty_images_data(), {}
+
+    def extract_row_images_from_excel(self, uploaded_file):
+        """Extract the images of every part row of a catalogue, keyed by sheet row"""
+        try:
+            with stage('image extraction'):
+                buffer = io.BytesIO(uploaded_file.getvalue())
+                if not zipfile.is_zipfile(buffer):
+                    logger.debug("No images in a legacy .xls upload")
+                    return {}
+                wb = load_workbook(buffer, read_only=True, data_only=True)
+                header_positions, header_row = self.scan_image_headers(wb.active)
+                wb.close()
+                if not header_positions:
+                    return {}
+                with zipfile.ZipFile(buffer) as archive:
+                    row_images = self.assign_row_images(read_sheet_images(archive), header_positions, header_row)
+                return {row: self.decode_images(images_data) for row, images_data in row_images.items()}
+        except Exception as e:
+            logger.error("Could not extract images: %s", e)
+            return {}
+
+    def scan_image_headers(self, ws):
+        """Find the image category headers of a worksheet with a bounded, streaming scan.
+
+        Only the first ``IMAGE_HEADER_ROWS`` rows and ``IMAGE_HEADER_COLUMNS``
+        columns are read, and reading stops at the header row, so a stray
+        formatted cell far to the right of the data does not make every
+        scanned row thousands of cells wide.
+        """
+        rows = ws.iter_rows(min_row=1, max_row=IMAGE_HEADER_ROWS, max_col=IMAGE_HEADER_COLUMNS, values_only=True)
+        return self.find_image_headers(rows)
+
+    def find_image_headers(self, rows):
+        """Find the image category headers in the first rows of a sheet.
+
+        Returns the 0-based column of each category and the 1-based row of
+        the first row holding at least two of them. ``rows`` is consumed
+        lazily and the headers found in a row are cached on its values.
+        """
+        for row_idx, row in enumerate(rows, 1):
+            row = _trim_row(row)
+            with self._cache_lock:
+                found = self._image_header_rows.get(row)
+            if found is None:
+                found = self._match_image_headers(row)
+                self._cache(self._image_header_rows, row, found, _HEADER_CACHE_SIZE)
+            temp_positions, row_headers_found = found
+            # If we found multiple headers in this row, it's likely the header row
+            if row_headers_found >= 2:
+                return dict(temp_positions), row_idx
+        return {}, None
+
+    def _match_image_headers(self, row):
+        """Image categories named in one row: their 0-based columns and the number of matches"""
+        row_headers_found = 0
+        temp_positions = {}
+        for col_idx, cell_value in enumerate(row, 1):
+            if cell_value:
+                cell_value = str(cell_value).strip().lower()
+            
+                # More flexible header matching
+                if any(keyword in cell_value for keyword in ["current packaging", "current pack"]):
+                    temp_positions['Current Packaging'] = col_idx - 1  # Convert to 0-based
+                    row_headers_found += 1
+                elif any(keyword in cell_value for keyword in ["primary packaging", "primary pack"]):
+                    temp_positions['Primary Packaging'] = col_idx - 1
+                    row_headers_found += 1
+                elif any(keyword in cell_value for keyword in ["secondary packaging", "secondary pack"]):
+                    temp_positions['Secondary Packaging'] = col_idx - 1
+                    row_headers_found += 1
+                elif "label" in cell_value:
+                    temp_positions['Label'] = col_idx - 1
+                    row_headers_found += 1
+        return temp_positions, row_headers_found
+
+    def assign_images(self, sheet_images, header_positions, header_row):
+        """Assign the raw bytes of anchored sheet images to the category of the nearest header column"""
+        images_data = self.empty_images_data()
+        for sheet_image in sheet_images:
+            try:
+                if sheet_image.col is None or sheet_image.row is None:
+                    continue
+                col_idx = sheet_image.col  # 0-based
+                row_idx = sheet_image.row + 1  # Convert to 1-based for comparison
+                # Only consider images that are BELOW the header row
+                if not (header_row and row_idx > header_row):
+                    continue
+
+                # Find the closest matching header column
+                best_match = None
+                min_distance = float('inf')
+                for category, expected_col in header_positions.items():
+                    distance = abs(col_idx - expected_col)
+                    if distance < min_distance:
+                        min_distance = distance
+                        best_match = category
+
+                # Assign to best match if within reasonable distance (allow 1-2 column difference)
+                if best_match and min_distance <= 2:
+                    pil_image = sheet_image.data
+                    # Special handling: Current and Primary packaging should have same image
+                    if best_match == 'Current Packaging':
+                        images_data['Current Packaging'] = pil_image
+                        # Also assign to Primary Packaging if it doesn't have an image yet
+                        if not images_data['Primary Packaging']:
+                            images_data['Primary Packaging'] = pil_image
+                    elif best_match == 'Primary Packaging':
+                        images_data['Primary Packaging'] = pil_image
+                        # Also assign to Current Packaging if it doesn't have an image yet
+                        if not images_data['Current Packaging']:
+                            images_data['Current Packaging'] = pil_image
+                    else:
+                        # For Secondary Packaging and Label, assign normally
+                        images_data[best_match] = pil_image
+                else:
+                    # Fallback: assign based on column order
+                    sorted_headers = sorted(header_positions.items(), key=lambda x: x[1])
+                    for category, _ in sorted_headers:
+                        if not images_data[category]:
+                            images_data[category] = sheet_image.data
+                            break
+            except Exception:
+                # Silently continue if there's an error with an individual image
+                continue
+
+        # If Current and Primary are still empty but we have images, try a simpler approach
+        if not any(images_data.values()) and sheet_images:
+            # Simple fallback: assign first few images to categories in order
+            categories = ['Current Packaging', 'Primary Packaging', 'Secondary Packaging', 'Label']
+            for sheet_image, category in zip(sheet_images, categories):
+                images_data[category] = sheet_image.data
+
+                # If assigning to Current, also assign to Primary (they should be same)
+                if category == 'Current Packaging':
+                    images_data['Primary Packaging'] = sheet_image.data
+                elif category == 'Primary Packaging':
+                    images_data['Current Packaging'] = sheet_image.data
+        return images_data
+
+    def assign_row_images(self, sheet_images, header_positions, header_row):
+        """Assign anchored sheet images to the part row they sit on.
+
+        The anchors are sorted once and every image is bucketed by its sheet
+        row and the nearest header column (within two columns, found by
+        bisection; farther images take the first free category of their
+        row). Returns ``{1-based sheet row: images_data}`` of raw picture
+        bytes, or an empty dict unless at least two rows hold images: a
+        sheet with a single set of pictures applies it to every part, see
+        ``assign_images``.
+        """
+        header_columns = sorted((col, category) for category, col in header_positions.items())
+        columns = [col for col, _ in header_columns]
+        anchored = sorted(
+            (sheet_image for sheet_image in sheet_images
+             if sheet_image.col is not None and sheet_image.row is not None and sheet_image.row + 1 > header_row),
+            key=lambda sheet_image: (sheet_image.row, sheet_image.col),
+        )
+
+        row_images = {}
+        for sheet_image in anchored:
+            images_data = row_images.setdefault(sheet_image.row + 1, self.empty_images_data())
+            position = bisect.bisect_left(columns, sheet_image.col)
+            # The nearer of the header columns on either side, the left one on a tie
+            neighbours = [i for i in (position - 1, position) if 0 <= i < len(columns)]
+            nearest = min(neighbours, key=lambda i: abs(columns[i] - sheet_image.col))
+            if abs(columns[nearest] - sheet_image.col) <= 2:
+                category = header_columns[nearest][1]
+            else:
+                category = next((category for _, category in header_columns if not images_data[category]), None)
+                if category is None:
+                    continue
+            images_data[category] = sheet_image.data
+
+        if len(row_images) < 2:
+            return {}
+        for images_data in row_images.values():
+            # Current and Primary packaging show the same picture when only one is given
+            images_data['Current Packaging'] = images_data['Current Packaging'] or images_data['Primary Packaging']
+            images_data['Primary Packaging'] = images_data['Primary Packaging'] or images_data['Current Packaging']
+        return row_images
+
+    def images_for_record(self, record, images_data=None, row_images=None):
+        """Decoded images of one part: those on its own row of a catalogue, else the sheet's"""
+        if row_images:
+            return self.decode_images(row_images.get(record.get(SOURCE_ROW_KEY), self.empty_images_data()))
+        return self.decode_images(images_data)
+
+    def decode_images(self, images_data):
+        """Images of an ``images_data`` holding raw picture bytes, opened for rendering.
+
+        Uploads are cached and shipped to batch workers as raw bytes, a
+        fraction of the size of decoded bitmaps; each part's pictures are
+        only opened when it is rendered. Values that are already images
+        are kept as they are.
+        """
+        if not images_data:
+            return images_data
+        decoded = {}
+        for category, image in images_data.items():
+            if isinstance(image, bytes):
+                try:
+                    image = open_image(image)
+                except Exception as e:
+                    logger.warning("Could not open the %s image: %s", category, e)
+                    image = None
+            decoded[category] = image
+        return decoded
+
+    def apply_border_to_range(self, ws, start_cell, end_cell):
+        """Apply borders to a range of cells"""
+        border = THIN_BORDER
+
+        # Parse cell references
+        start_col = ord(start_cell[0]) - ord('A')
+        start_row = int(start_cell[1:])
+        end_col = ord(end_cell[0]) - ord('A')
+        end_row = int(end_cell[1:])
+        
+        for row in range(start_row, end_row + 1):
+            for col in range(start_col, end_col + 1):
+                cell = ws.cell(row=row, column=col+1)
+                cell.border = border
+
+    def add_image_to_cell_range(self, ws, pil_image, start_cell, end_cell):
+        """Add PIL image to specified cell range in worksheet with proper sizing"""
+        try:
+            # Pixel box of the range, with the conversions the layout's render plan uses
+            column_widths = {letter: dimension.width for letter, dimension in ws.column_dimensions.items()}
+            row_heights = {row: dimension.height for row, dimension in ws.row_dimensions.items()}
+            total_width, total_height = range_box(column_widths, row_heights, f"{start_cell}:{end_cell}")
+
+            # Resample to the range's pixel box (keeping the aspect ratio) and
+            # encode as PNG or JPEG depending on the picture
+            encoded = encode_for_box(pil_image, total_width, total_height,
+                                     self.image_dpi_scale, self.image_quality)
+            img = Image(io.BytesIO(encoded.data))
+            img.width = encoded.width
+            img.height = encoded.height
+        
+            # Add image to worksheet at the start cell
+            ws.add_image(img, start_cell)
+        
+            logger.debug("Image added to %s:%s with dimensions %sx%s", start_cell, end_cell, img.width, img.height)
+            return True
+        
+        except Exception as e:
+            logger.warning("Error adding image to cell range %s:%s: %s", start_cell, end_cell, e)
+            return False
+
+
+    # Alternative method with more precise cell dimension calculation
+    def add_image_to_cell_range_precise(self, ws, pil_image, start_cell, end_cell):
+        """Add PIL image to specified cell range with more precise dimension calculation"""
+        try:
+            from openpyxl.utils import column_index_from_string, get_column_letter
+        
+            # Convert PIL image to bytes
+            img_buffer = io.BytesIO()
+            pil_image.save(img_buffer, format='PNG')
+            img_buffer.seek(0)
+        
+            # Create openpyxl Image
+            img = Image(img_buffer)
+        
+            # Parse cell coordinates more precisely
+            start_col_idx = column_index_from_string(start_cell.split(start_cell.lstrip('ABCDEFGHIJKLMNOPQRSTUVWXYZ'))[0])
+            start_row = int(start_cell.lstrip('ABCDEFGHIJKLMNOPQRSTUVWXYZ'))
+            end_col_idx = column_index_from_string(end_cell.split(end_cell.lstrip('ABCDEFGHIJKLMNOPQRSTUVWXYZ'))[0])
+            end_row = int(end_cell.lstrip('ABCDEFGHIJKLMNOPQRSTUVWXYZ'))
+        
+            # Calculate total dimensions more precisely
+            total_width_chars = 0
+            for col_idx in range(start_col_idx, end_col_idx + 1):
+                col_letter = get_column_letter(col_idx)
+                col_width = ws.column_dimensions[col_letter].width or 8.43  # Excel default
+                total_width_chars += col_width
+        
+            total_height_points = 0
+            for row_num in range(start_row, end_row + 1):
+                row_height = ws.row_dimensions[row_num].height or 15  # Excel default
+                total_height_points += row_height
+        
+            # Convert to pixels (more accurate conversion)
+            # 1 character width ≈ 7 pixels, 1 point ≈ 1.333 pixels
+            total_width_pixels = total_width_chars * 7 * 0.9  # 10% padding
+            total_height_pixels = total_height_points * 1.333 * 0.9  # 10% padding
+        
+            # Maintain aspect ratio
+            original_width, original_height = pil_image.size
+        
+            # Calculate scaling to fit within the cell range
+            width_ratio = total_width_pixels / original_width
+            height_ratio = total_height_pixels / original_height
+            scale_ratio = min(width_ratio, height_ratio)
+        
+            # Apply scaling
+            img.width = int(original_width * scale_ratio)
+            img.height = int(original_height * scale_ratio)
+        
+            # Add image to worksheet
+            ws.add_image(img, start_cell)
+        
+            logger.debug("Precise image sizing: %s:%s -> %sx%spx (%.1f chars x %.1f pts)",
+                         start_cell, end_cell, img.width, img.height, total_width_chars, total_height_points)
+        
+            return True
+        
+        except Exception as e:
+            logger.warning("Error in precise image placement: %s", e)
+            # Fallback to simpler method
+            return self.add_image_to_cell_range(ws, pil_image, start_cell, end_cell)
+
+
+    # Enhanced method with specific handling for your template's cell ranges
+    def add_image_to_template_cell_range(self, ws, pil_image, start_cell, end_cell):
+        """Stretch an image over one of the template's image ranges.
+
+        The picture is sized to the pixel box of the range's image slot in
+        the render plan; ranges that are not image slots of the layout are
+        fitted by ``add_image_to_cell_range`` instead.
+        """
+        try:
+            # Convert PIL image to bytes
+            img_buffer = io.BytesIO()
+            pil_image.save(img_buffer, format='PNG')
+            img_buffer.seek(0)
+            # Create openpyxl Image
+            img = Image(img_buffer)
+
+            # Get the key like 'A37:C42'
+            range_key = f"{start_cell}:{end_cell}"
+            category = self.image_categories.get((start_cell, end_cell))
+            # Fallback to original method if range unknown
+            if category is None:
+                logger.debug("Unknown cell range %s, using fallback.", range_key)
+                return self.add_image_to_cell_range(ws, pil_image, start_cell, end_cell)
+            # Use the width/height of the range's image slot
+            target_width, target_height = (int(size) for size in self.image_slots[category].box)
+
+            # 🔥 Force the image to exactly match the cell range size
+            img.width = target_width
+            img.height = target_height
+
+            logger.debug("Placing image at %s with size %sx%spx", range_key, img.width, img.height)
+
+            # Place the image in the worksheet
+            ws.add_image(img, start_cell)
+            return True
+        except Exception as e:
+            logger.warning("Error placing image at %s:%s: %s", start_cell, end_cell, e)
+            return False
+
+    def get_template_workbook(self):
+        """Return a fresh copy of the template skeleton, building it only once per version"""
+        with stage('skeleton build'):
+            skeleton = _compiled_templates.get(TEMPLATE_VERSION)
+            if skeleton is None:
+                skeleton = pickle.dumps(self.create_exact_template_excel(), protocol=pickle.HIGHEST_PROTOCOL)
+                _compiled_templates[TEMPLATE_VERSION] = skeleton
+            # Unpickling the prebuilt workbook is far cheaper than rebuilding every merge and style
+            wb = pickle.loads(skeleton)
+            wb.properties.created = datetime.now(tz=timezone.utc).replace(tzinfo=None)
+        return wb
+
+    def create_exact_template_excel(self):
+        """Create the exact Excel template matching the image, from the compiled layout"""
+        plan = get_render_plan()
+        wb = openpyxl.Workbook()
+        ws = wb.active
+        ws.title = plan.title
+        add_template_styles(wb)
+
+        for letter, width in plan.column_widths.items():
+            ws.column_dimensions[letter].width = width
+        for row, height in plan.row_heights.items():
+            ws.row_dimensions[row].height = height
+
+        for cell_range in plan.merges:
+            ws.merge_cells(cell_range)
+        # Covered cells of the merged ranges are styled too, for their borders
+        for row, runs in plan.style_runs.items():
+            for first_col, last_col, style in runs:
+                for col in range(first_col, last_col + 1):
+                    ws.cell(row=row, column=col).style = style
+        for coordinate, value in plan.values.items():
+            ws[coordinate] = value
+
+        return wb
+    
+    def variable_cell_values(self, data_dict):
+        """Map each template cell that a part's data fills to the value it receives"""
+        values = {}
+        for field, cell in self.cell_mapping.items():
+            if field in data_dict and data_dict[field]:
+                values[cell] = data_dict[field]
+
+        # Procedure steps (11 steps) are written as text
+        for procedure_key, cell in self.procedure_cells.items():
+            if procedure_key in data_dict and data_dict[procedure_key]:
+                procedure_value = str(data_dict[procedure_key])
+                # Skip if it's a slice object representation
+                if not procedure_value.startswith('slice('):
+                    values[cell] = procedure_value
+                else:
+                    logger.warning("Skipping %s - contains slice object: %s", procedure_key, procedure_value)
+        return values
+
+    def populate_template_with_data(self, wb, data_dict, procedures_list=None, images_data=None):
+        """Populate the template with data from dictionary and optional procedures"""
+        ws = wb.active
+        # Populate cells with data, procedure steps included
+        with stage('populate'):
+            for cell, value in self.variable_cell_values(data_dict).items():
+                try:
+                    ws[cell] = value
+                except Exception as e:
+                    logger.warning("Error populating cell %s with %r (%s): %s", cell, value, type(value).__name__, e)
+        
+        # Populate procedures if provided as separate list - UPDATED ROW NUMBERS
+        if procedures_list:
+            try:
+                # Ensure procedures_list is actually a list and not a slice object
+                if isinstance(procedures_list, list):
+                    procedure_cells = list(self.procedure_cells.values())
+                    for i, procedure in enumerate(procedures_list[:len(procedure_cells)]):
+                        if procedure and str(procedure).strip():  # Only add non-empty procedures
+                            # Convert to string and check it's not a slice
+                            procedure_str = str(procedure)
+                            if not procedure_str.startswith('slice('):
+                                ws[procedure_cells[i]] = procedure_str
+                            else:
+                                logger.warning("Skipping procedure %s - contains slice object: %s", i + 1, procedure_str)
+                else:
+                    logger.warning("procedures_list is not a list. Type: %s, Value: %r",
+                                   type(procedures_list).__name__, procedures_list)
+            except Exception as e: 
+                logger.warning("Error handling procedures_list %r: %s", procedures_list, e)
+        
+        # Handle images if provided - UPDATED CELL REFERENCES
+        if images_data:
+            with stage('image embed'):
+                try:
+                    # Add images to specific cell ranges - UPDATED ROW NUMBERS
+                    for category, (start_cell, end_cell) in self.image_ranges.items():
+                        if images_data.get(category):
+                            self.add_image_to_cell_range(ws, images_data[category], start_cell, end_cell)
+                except Exception as e:
+                    logger.warning("Error handling images: %s", e)
+        
+        return wb
+
+    def build_form_data(self, extracted_data, procedure_type=None):
+        """Merge the steps of the selected packaging type into a part's data"""
+        updated_form_data = extracted_data.copy()
+        # Pack weights the data leaves blank are derived from its quantities and weights
+        if extracted_data:
+            updated_form_data.update(self.derived_fields(extracted_data))
+        # Update only the procedure steps if a type is selected
+        if procedure_type and procedure_type in self.packaging_procedures:
+            procedure_steps = self.get_procedure_steps(procedure_type, extracted_data)
+            for i, step in enumerate(procedure_steps, 1):
+                updated_form_data[f'Procedure Step {i}'] = step
+            # Also update the primary packaging type
+            updated_form_data['Primary Packaging Type'] = procedure_type
+        return updated_form_data
+
+    def build_batch_form_data(self, records, procedure_type=None):
+        """build_form_data for many parts, filling the procedure steps column-wise"""
+        records = list(records)
+        if not records:
+            return []
+        frame = _part_frame(records)
+        derived = _derived_values(frame)
+        if not (procedure_type and procedure_type in self.packaging_procedures):
+            return [{**record, **derived_fields} for record, derived_fields in zip(records, derived)]
+        column_steps = self.render_procedure_column(procedure_type, frame)
+        batch = []
+        for record, derived_fields, procedure_steps in zip(records, derived, column_steps):
+            updated_form_data = {**record, **derived_fields}
+            if not record:
+                procedure_steps = self.get_procedure_steps(procedure_type, record)
+            for i, step in enumerate(procedure_steps, 1):
+                updated_form_data[f'Procedure Step {i}'] = step
+            updated_form_data['Primary Packaging Type'] = procedure_type
+            batch.append(updated_form_data)
+        return batch
+
+    def iter_batch_form_data(self, records, procedure_type=None, chunksize=BATCH_CHUNK_SIZE):
+        """build_batch_form_data over a stream of records, ``chunksize`` records at a time"""
+        records = iter(records)
+        while True:
+            chunk = list(islice(records, chunksize))
+            if not chunk:
+                return
+            yield from self.build_batch_form_data(chunk, procedure_type)
+
+    def generate_instruction(self, extracted_data, procedure_type=None, images_data=None):
+        """Build a populated instruction workbook for one part"""
+        updated_form_data = self.build_form_data(extracted_data, procedure_type)
+        wb = self.get_template_workbook()
+        return self.populate_template_with_data(wb, updated_form_data, None, images_data)
+
+    def batch_file_name(self, record, index):
+        """File name for the instruction of the index-th part of a batch"""
+        part_no = re.sub(r'[^A-Za-z0-9._-]+', '_', str(record.get('Part No.', ''))).strip('._')
+        name = f"Packaging_Instruction_{index:04d}"
+        if part_no:
+            name = f"{name}_{part_no}"
+        return f"{name}.xlsx"
+
+    def batch_sheet_title(self, record, index):
+        """Worksheet title for the index-th part of a single-workbook batch"""
+        part_no = re.sub(r'[\[\]:*?/\\]+', '_', str(record.get('Part No.', ''))).strip("' ")
+        # Excel caps sheet titles at 31 characters; the index keeps them unique
+        return f"{index:04d} {part_no}".strip()[:31]
+
+    def generate_batch(self, records, procedure_type=None, images_data=None, row_images=None):
+        """Yield (file_name, workbook) for every part record, one sheet per part"""
+        for index, updated_form_data in enumerate(self.build_batch_form_data(records, procedure_type), 1):
+            wb = self.get_template_workbook()
+            part_images = self.images_for_record(updated_form_data, images_data, row_images)
+            wb = self.populate_template_with_data(wb, updated_form_data, None, part_images)
+            yield self.batch_file_name(updated_form_data, index), wb
@@ -0,0 +1,48 @@
+"""Batch jobs running side by side each get all of their pictures."""
+import io
+import time
+import zipfile
+
+from batch_jobs import DONE, JobQueue
+from benchmark import IMAGE_HEADERS, synthetic_workbook
+from template_manager import ExactPackagingTemplateManager
+
+PARTS = 8
+
+
+def _media(workbook):
+    return sum(name.startswith('xl/media/') for name in zipfile.ZipFile(io.BytesIO(workbook)).namelist())
+
+
+def _wait(queue, job_ids, timeout=120):
+    deadline = time.time() + timeout
+    while any(queue.get(job_id).active for job_id in job_ids):
+        assert time.time() < deadline, "batch jobs did not finish"
+        time.sleep(0.05)
+    return [queue.get(job_id) for job_id in job_ids]
+
+
+def test_concurrent_jobs_keep_every_image():
+    manager = ExactPackagingTemplateManager()
+    # One picture under each image header for every part
+    content = synthetic_workbook(PARTS, images=PARTS * len(IMAGE_HEADERS), image_size=(120, 90))
+    _, images_data, row_images = manager.ingest_excel(io.BytesIO(content))
+    records = manager.extract_records_from_excel(io.BytesIO(content))
+
+    queue = JobQueue(manager, max_jobs=2)
+    try:
+        job_ids = [queue.submit(records, 'BOX IN BOX', images_data, row_images, writer=writer, workers=2)
+                   for writer in ('openpyxl', 'ooxml')]
+        job_ids.append(queue.submit(records, 'BOX IN BOX', images_data, row_images, output='workbook'))
+        jobs = _wait(queue, job_ids)
+
+        assert [job.state for job in jobs] == [DONE] * 3
+        for job in jobs[:2]:
+            with zipfile.ZipFile(job.result_path) as archive:
+                parts = [archive.read(name) for name in archive.namelist()]
+            assert len(parts) == PARTS
+            assert [_media(part) for part in parts] == [len(IMAGE_HEADERS)] * PARTS
+        with open(jobs[2].result_path, 'rb') as handle:
+            assert _media(handle.read()) == PARTS * len(IMAGE_HEADERS)
+    finally:
+        queue.shutdown()
@@ -0,0 +1,46 @@
+"""Values under a column header naming a unit are read in their field's unit."""
+import io
+
+import openpyxl
+
+from template_manager import ExactPackagingTemplateManager
+
+
+def _upload(header, *rows):
+    wb = openpyxl.Workbook()
+    wb.active.append(header)
+    for row in rows:
+        wb.active.append(row)
+    buffer = io.BytesIO()
+    wb.save(buffer)
+    return buffer.getvalue()
+
+
+HEADER = ['Part No.', 'Inner L (cm)', 'Inner W (cm)', 'Inner H (cm)', 'Inner Qty/Pack', 'Primary L-mm (cm)',
+          'Part Unit Weight (g)']
+
+
+def test_cm_header_fills_mm_cells_and_procedure_steps():
+    manager = ExactPackagingTemplateManager()
+    content = _upload(HEADER, ['P1', 30, 20, 10, 4, 50, 250])
+
+    for records in (manager.extract_records_from_excel(io.BytesIO(content)),
+                    list(manager.iter_records_from_excel(io.BytesIO(content)))):
+        form_data = manager.build_form_data(records[0], 'BOX IN BOX')
+        assert form_data['Procedure Step 3'] == \
+            "Put 4 such carton boxes into another carton box [L-300 mm, W-200 mm, H-100 mm]"
+
+        wb = manager.populate_template_with_data(manager.get_template_workbook(), form_data)
+        assert wb.active[manager.cell_mapping['Primary L-mm']].value == '500'
+
+
+def test_unconverted_header_unit_is_reported():
+    manager = ExactPackagingTemplateManager()
+    records = manager.extract_records_from_excel(io.BytesIO(_upload(HEADER, ['P1', 30, 20, 10, 4, 50, 250])))
+
+    # Weights follow the part's weight unit, so grams are left as written and flagged
+    assert records[0]['Part Unit Weight'] == '250'
+    issues = manager.validate_records(records).issues
+    flagged = issues[issues['Field'] == 'Part Unit Weight']
+    assert flagged['Row'].tolist() == [1]
+    assert "'g'" in flagged['Problem'].iloc[0]
@@ -0,0 +1,284 @@
+"""Check the part and pack data of a batch and derive the fields it leaves blank.
+
+Part records hold whatever text the master sheet had, so a dimension of
+"12O", a weight in grams or a part bigger than its box used to reach the
+issued sheets unnoticed. Here every field is parsed as a whole column: the
+numbers and their unit suffixes ("250 g", "1.2 m") are converted to
+kilograms and millimetres, the pack weights a sheet leaves blank are derived
+as Qty/Pack x part unit weight + empty weight, and the checks are boolean
+masks over the batch. ``validate_parts`` returns the derived fields and a
+table with one line per problem found, so checking ten thousand parts takes
+a fraction of a second.
+"""
+import logging
+import re
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Unit suffixes and their factor to the base unit of each kind of value
+LENGTH_UNITS = {'mm': 1.0, 'cm': 10.0, 'm': 1000.0}
+WEIGHT_UNITS = {
+    'kg': 1.0, 'kgs': 1.0,
+    'g': 0.001, 'gm': 0.001, 'gms': 0.001, 'gram': 0.001, 'grams': 0.001,
+}
+COUNT_UNITS = {'no': 1.0, 'nos': 1.0, 'pc': 1.0, 'pcs': 1.0}
+
+# Weights without a unit of their own are in the part's weight unit, kilograms if none is given
+WEIGHT_UNIT_FIELD = 'Part Weight Unit'
+DEFAULT_WEIGHT_UNIT = 'kg'
+
+# Texts that mark a cell as deliberately left blank, compared in lower case
+BLANK_MARKERS = frozenset(['', '-', 'na', 'n/a', 'nil', 'none'])
+
+# Relative difference tolerated between a given pack weight and the derived one
+WEIGHT_TOLERANCE = 0.05
+
+# A number followed by a unit: "1200 mm", "0.25kg", "4 Nos."
+_MEASURE_RE = re.compile(r'^([-+]?(?:\d+(?:\.\d*)?|\.\d+))\s*([a-z]+)\.?$', re.IGNORECASE)
+
+# Columns of the issue table
+ISSUE_COLUMNS = ['Row', 'Part No.', 'Field', 'Problem']
+
+# One level of packaging and the fields that describe it; each field lists
+# the record keys that may hold it, first match wins
+PackLevel = namedtuple('PackLevel', ['name', 'dimensions', 'quantity', 'empty_weight', 'pack_weight'])
+
+PACK_LEVELS = (
+    PackLevel('Part', (('Part L',), ('Part W',), ('Part H',)), None, None, None),
+    PackLevel('Inner', (('Inner L',), ('Inner W',), ('Inner H',)),
+              ('Inner Qty/Pack',), ('Inner Empty Weight',), ('Inner Pack Weight',)),
+    PackLevel('Primary', (('Primary L-mm', 'Primary L'), ('Primary W-mm', 'Primary W'), ('Primary H-mm', 'Primary H')),
+              ('Primary Qty/Pack',), ('Primary Empty Weight',), ('Primary Pack Weight',)),
+    PackLevel('Secondary', (('Secondary L-mm',), ('Secondary W-mm',), ('Secondary H-mm',)),
+              ('Secondary Qty/Pack',), ('Secondary Empty Weight',), ('Secondary Pack Weight',)),
+)
+UNIT_WEIGHT = ('Part Unit Weight',)
+
+# Unit a bare number of a field is read in; weights are read in the part's
+# weight unit, which is the default one unless the sheet gives another
+FIELD_UNITS = {key: 'mm' for level in PACK_LEVELS for keys in level.dimensions for key in keys}
+FIELD_UNITS.update({key: 'nos' for level in PACK_LEVELS if level.quantity is not None for key in level.quantity})
+FIELD_UNITS.update({key: DEFAULT_WEIGHT_UNIT for key in UNIT_WEIGHT})
+FIELD_UNITS.update({
+    key: DEFAULT_WEIGHT_UNIT
+    for level in PACK_LEVELS if level.quantity is not None
+    for key in level.empty_weight + level.pack_weight
+})
+
+# Every record key the derived fields depend on
+DERIVATION_FIELDS = (WEIGHT_UNIT_FIELD,) + UNIT_WEIGHT + tuple(
+    key
+    for level in PACK_LEVELS if level.quantity is not None
+    for keys in (level.quantity, level.empty_weight, level.pack_weight)
+    for key in keys
+)
+
+# Pack weights derived where blank, and the problems found, of a batch
+Validation = namedtuple('Validation', ['derived', 'issues'])
+
+
+def same_unit(unit, other):
+    """Whether two unit suffixes name the same unit, such as 'kg' and 'kgs'"""
+    for units in (LENGTH_UNITS, WEIGHT_UNITS, COUNT_UNITS):
+        if unit in units and other in units:
+            return units[unit] == units[other]
+    return False
+
+
+def _text(frame, keys):
+    """Stripped text of the first of ``keys`` holding a value, per row, NA if none does"""
+    text = pd.Series(pd.NA, index=frame.index, dtype='string')
+    for key in reversed(keys):
+        if key in frame:
+            column = frame[key].astype('string').str.strip().str.replace(',', '', regex=False)
+            text = column.mask(column.str.lower().isin(BLANK_MARKERS)).fillna(text)
+    return text
+
+
+def _format(values):
+    """Text of a column of numbers, with at most three decimals"""
+    text = values.astype(object).map(lambda value: f'{value:.3f}'.rstrip('0').rstrip('.'), na_action='ignore')
+    return text.astype(object)
+
+
+def _sides_text(sides):
+    """'LxWxH' text of every row of an (n, 3) array of sides"""
+    columns = [_format(pd.Series(sides[:, side])) for side in range(3)]
+    return (columns[0] + 'x' + columns[1] + 'x' + columns[2]).to_numpy()
+
+
+class _Parsed:
+    """Numbers of one field over a batch, in its base unit"""
+
+    def __init__(self, frame, keys, units, default_factor=1.0):
+        self.field = keys[0]
+        self.text = _text(frame, keys)
+        # Plain numbers are parsed in bulk; only the rest can carry a unit suffix
+        number = pd.to_numeric(self.text, errors='coerce')
+        self.value = number * default_factor
+        rest = self.text.notna() & number.isna()
+        if rest.any():
+            parts = self.text[rest].str.extract(_MEASURE_RE)
+            factor = parts[1].str.lower().map(units).astype(float)
+            self.value[rest] = pd.to_numeric(parts[0], errors='coerce') * factor
+        # Present but not a number in a known unit
+        self.invalid = self.text.notna() & self.value.isna()
+
+
+class _Batch:
+    """The weight fields of a batch parsed once, shared by the derivation and the checks"""
+
+    def __init__(self, frame, levels=PACK_LEVELS):
+        self.frame = frame
+        self.unit = _text(frame, (WEIGHT_UNIT_FIELD,))
+        factor = self.unit.str.lower().map(WEIGHT_UNITS)
+        self.unknown_unit = self.unit.notna() & factor.isna()
+        self.weight_factor = factor.fillna(WEIGHT_UNITS[DEFAULT_WEIGHT_UNIT]).astype(float)
+        # Unit the weights of each row are read and derived in, as the sheet spells it
+        self.weight_unit = self.unit.mask(self.unknown_unit).fillna(DEFAULT_WEIGHT_UNIT).astype(object)
+
+        self.unit_weight = _Parsed(frame, UNIT_WEIGHT, WEIGHT_UNITS, self.weight_factor)
+        self.quantity, self.empty_weight, self.pack_weight = {}, {}, {}
+        for level in levels:
+            if level.quantity is None:
+                continue
+            self.quantity[level.name] = _Parsed(frame, level.quantity, COUNT_UNITS)
+            self.empty_weight[level.name] = _Parsed(frame, level.empty_weight, WEIGHT_UNITS, self.weight_factor)
+            self.pack_weight[level.name] = _Parsed(frame, level.pack_weight, WEIGHT_UNITS, self.weight_factor)
+
+    def expected_pack_weight(self, level_name):
+        """Qty/Pack x part unit weight + empty weight in kilograms, NaN where a term is missing"""
+        return (self.quantity[level_name].value * self.unit_weight.value
+                + self.empty_weight[level_name].value)
+
+    def derived(self):
+        """Pack weights of the rows that leave them blank, as text with the part's weight unit"""
+        derived = {}
+        for level in PACK_LEVELS:
+            if level.name not in self.pack_weight:
+                continue
+            expected = self.expected_pack_weight(level.name)
+            blank = self.pack_weight[level.name].text.isna()
+            text = _format((expected / self.weight_factor).where(blank))
+            derived[level.pack_weight[0]] = text.where(text.isna(), text + ' ' + self.weight_unit)
+        return pd.DataFrame(derived, index=self.frame.index)
+
+
+def _has(frame, keys):
+    return any(key in frame for key in keys)
+
+
+def derive_fields(frame):
+    """Pack weights derived for the rows of ``frame`` that leave them blank, NaN elsewhere"""
+    # Only the levels whose terms the batch has columns for are parsed
+    levels = [
+        level for level in PACK_LEVELS
+        if level.quantity is not None and _has(frame, level.quantity) and _has(frame, level.empty_weight)
+    ]
+    if not levels or not _has(frame, UNIT_WEIGHT):
+        return pd.DataFrame(index=frame.index)
+    return _Batch(frame, levels).derived()
+
+
+def validate_parts(frame, required=None, rows=None, header_units=None):
+    """Check a batch of parts, one row of ``frame`` per part.
+
+    ``required`` maps the label of each field that must hold a value to the
+    record keys that may hold it, such as the placeholders of the selected
+    procedure. ``rows`` numbers the parts in the issue table, 1 to n by
+    default. ``header_units`` maps fields to the unit their column header
+    names but the values could not be converted from; each is reported on
+    row 1, the header. Returns the derived pack weights and the issues
+    found, in row order.
+    """
+    batch = _Batch(frame)
+    if rows is None:
+        rows = pd.Series(np.arange(1, len(frame) + 1), index=frame.index)
+    part_numbers = frame['Part No.'] if 'Part No.' in frame else pd.Series(pd.NA, index=frame.index, dtype='string')
+    issues = []
+
+    def report(mask, field, problem):
+        """Add the rows of ``mask``; ``problem`` is their text, or a function giving it for those rows"""
+        if not mask.any():
+            return
+        issues.append(pd.DataFrame({
+            'Row': rows[mask],
+            'Part No.': part_numbers[mask],
+            'Field': field,
+            'Problem': problem(mask) if callable(problem) else problem,
+        }))
+
+    for field, unit in (header_units or {}).items():
+        issues.append(pd.DataFrame({
+            'Row': [1],
+            'Part No.': [pd.NA],
+            'Field': [field],
+            'Problem': [f"unit '{unit}' of the column header is not converted, the values are read without it"],
+        }))
+    for label, keys in (required or {}).items():
+        report(_text(frame, keys).isna(), label, "missing, the procedure would show XXX")
+    report(batch.unknown_unit, WEIGHT_UNIT_FIELD, lambda mask: "unknown weight unit '" + batch.unit[mask] + "'")
+
+    def check(parsed, allow_zero=False, whole=False):
+        report(parsed.invalid, parsed.field,
+               lambda mask: "'" + parsed.text[mask] + "' is not a number in a known unit")
+        value = parsed.value
+        if allow_zero:
+            report(value < 0, parsed.field, "must not be negative")
+        else:
+            report(value <= 0, parsed.field, "must be greater than zero")
+        if whole:
+            report((value > 0) & (value % 1 != 0), parsed.field, "must be a whole number")
+
+    dimensions = {
+        level.name: [_Parsed(frame, keys, LENGTH_UNITS) for keys in level.dimensions] for level in PACK_LEVELS
+    }
+    check(batch.unit_weight)
+    for level in PACK_LEVELS:
+        for parsed in dimensions[level.name]:
+            check(parsed)
+        if level.quantity is not None:
+            check(batch.quantity[level.name], whole=True)
+            check(batch.empty_weight[level.name], allow_zero=True)
+            check(batch.pack_weight[level.name])
+
+    # Each level must hold the one inside it, turned any way, so the sorted sides are
+    # compared; where a level has no dimensions, the next one must hold what it would
+    inside_name = inside_sides = None
+    for level in PACK_LEVELS:
+        sides = np.column_stack([parsed.value.to_numpy(dtype=float) for parsed in dimensions[level.name]])
+        sides = -np.sort(-sides, axis=1)
+        complete = ~np.isnan(sides).any(axis=1)
+        if inside_sides is None:
+            inside_name = np.full(len(frame), level.name, dtype=object)
+            inside_sides = sides
+            continue
+        known = ~np.isnan(inside_sides).any(axis=1)
+        too_small = complete & known & (sides < inside_sides).any(axis=1)
+        report(pd.Series(too_small, index=frame.index), f'{level.name} dimensions',
+               lambda mask, outer=sides[too_small], inner=inside_sides[too_small], names=inside_name[too_small]:
+               names + ' ' + _sides_text(inner) + f' mm does not fit in {level.name} ' + _sides_text(outer) + ' mm')
+        inside_name = np.where(complete, level.name, inside_name)
+        inside_sides = np.where(complete[:, None], sides, inside_sides)
+
+    for level in PACK_LEVELS:
+        if level.pack_weight is None:
+            continue
+        given = batch.pack_weight[level.name].value
+        expected = batch.expected_pack_weight(level.name)
+        report((given - expected).abs() > WEIGHT_TOLERANCE * expected, level.pack_weight[0],
+               lambda mask, given=given, expected=expected:
+               _format(given[mask] / batch.weight_factor[mask])
+               + " differs from Qty/Pack x unit weight + empty weight = "
+               + _format(expected[mask] / batch.weight_factor[mask]))
+
+    if issues:
+        table = pd.concat(issues).sort_values('Row', kind='stable').reset_index(drop=True)
+    else:
+        table = pd.DataFrame(columns=ISSUE_COLUMNS)
+    logger.debug("Validated %d parts: %d issues", len(frame), len(table))
+    return Validation(batch.derived(), table)
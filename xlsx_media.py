@@ -0,0 +1,93 @@
+"""Read the images embedded in an xlsx straight from its zip parts.
+
+Finding a picture only needs the drawing part of the sheet, its
+relationships and the media files, so there is no need to load the workbook
+(every cell and style) the way ``load_workbook`` does. Each image comes back
+with its anchor cell and its raw bytes; decoding them is left to the caller.
+"""
+import posixpath
+import xml.etree.ElementTree as ET
+from collections import namedtuple
+
+_MAIN_NS = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+_REL_NS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+_PKG_REL_NS = 'http://schemas.openxmlformats.org/package/2006/relationships'
+_XDR_NS = 'http://schemas.openxmlformats.org/drawingml/2006/spreadsheetDrawing'
+_A_NS = 'http://schemas.openxmlformats.org/drawingml/2006/main'
+
+_ANCHORS = ('twoCellAnchor', 'oneCellAnchor', 'absoluteAnchor')
+
+# An embedded picture: 0-based anchor column and row (None for absolute
+# anchors) and the raw bytes of its media part
+SheetImage = namedtuple('SheetImage', ['col', 'row', 'data'])
+
+
+def _rels_path(part):
+    folder, name = posixpath.split(part)
+    return posixpath.join(folder, '_rels', f'{name}.rels')
+
+
+def _relationships(archive, part):
+    """Map relationship ids of a part to (type, absolute target path)"""
+    try:
+        root = ET.fromstring(archive.read(_rels_path(part)))
+    except KeyError:
+        return {}
+    folder = posixpath.dirname(part)
+    rels = {}
+    for rel in root.iter(f'{{{_PKG_REL_NS}}}Relationship'):
+        target = rel.get('Target', '')
+        if rel.get('TargetMode') == 'External':
+            continue
+        if target.startswith('/'):
+            path = target.lstrip('/')
+        else:
+            path = posixpath.normpath(posixpath.join(folder, target))
+        rels[rel.get('Id')] = (rel.get('Type', '').rsplit('/', 1)[-1], path)
+    return rels
+
+
+def active_sheet_path(archive):
+    """Zip path of the worksheet openpyxl would return as ``wb.active``"""
+    workbook = ET.fromstring(archive.read('xl/workbook.xml'))
+    view = workbook.find(f'{{{_MAIN_NS}}}bookViews/{{{_MAIN_NS}}}workbookView')
+    active = int(view.get('activeTab', 0)) if view is not None else 0
+    sheets = workbook.findall(f'{{{_MAIN_NS}}}sheets/{{{_MAIN_NS}}}sheet')
+    if not sheets:
+        return None
+    sheet = sheets[active] if active < len(sheets) else sheets[0]
+    rels = _relationships(archive, 'xl/workbook.xml')
+    return rels.get(sheet.get(f'{{{_REL_NS}}}id'), (None, None))[1]
+
+
+def read_sheet_images(archive, sheet_path=None):
+    """List the pictures of a worksheet, in drawing order, from an open ZipFile"""
+    sheet_path = sheet_path or active_sheet_path(archive)
+    if sheet_path is None:
+        return []
+
+    images = []
+    for rel_type, drawing_path in _relationships(archive, sheet_path).values():
+        if rel_type != 'drawing':
+            continue
+        drawing = ET.fromstring(archive.read(drawing_path))
+        media = _relationships(archive, drawing_path)
+        for anchor in drawing:
+            if anchor.tag.split('}')[-1] not in _ANCHORS:
+                continue
+            blip = anchor.find(f'{{{_XDR_NS}}}pic/{{{_XDR_NS}}}blipFill/{{{_A_NS}}}blip')
+            if blip is None:
+                continue
+            target = media.get(blip.get(f'{{{_REL_NS}}}embed'))
+            if target is None:
+                continue
+            col = row = None
+            start = anchor.find(f'{{{_XDR_NS}}}from')
+            if start is not None:
+                col = int(start.findtext(f'{{{_XDR_NS}}}col'))
+                row = int(start.findtext(f'{{{_XDR_NS}}}row'))
+            try:
+                images.append(SheetImage(col, row, archive.read(target[1])))
+            except KeyError:
+                continue
+    return images